@@ -162,4 +162,48 @@ class Common_to_all_objects():
                 self.target_data_description = value
             if key == 'robust':
                 self.robust = value
+            if key == 'async_mode':
+                self.async_mode = value
+            if key == 'buffer_size':
+                self.buffer_size = value
+            if key == 'staleness_exponent':
+                self.staleness_exponent = value
+            if key == 'round_deadline':
+                self.round_deadline = value
+            if key == 'min_quorum':
+                self.min_quorum = value
+            if key == 'sampling_fraction':
+                self.sampling_fraction = value
+            if key == 'delta_broadcast':
+                self.delta_broadcast = value
+            if key == 'compression':
+                self.compression = value
+            if key == 'sparsity':
+                self.sparsity = value
+            if key == 'sparsification':
+                self.sparsification = value
+            if key == 'server_optimizer':
+                self.server_optimizer = value
+            if key == 'server_learning_rate':
+                self.server_learning_rate = value
+            if key == 'server_momentum':
+                self.server_momentum = value
+            if key == 'server_beta2':
+                self.server_beta2 = value
+            if key == 'patience':
+                self.patience = value
+            if key == 'min_delta':
+                self.min_delta = value
+            if key == 'convergence_tolerance':
+                self.convergence_tolerance = value
+            if key == 'eval_every':
+                self.eval_every = value
+            if key == 'val_subsample':
+                self.val_subsample = value
+            if key == 'eval_async':
+                self.eval_async = value
+            if key == 'checkpoint_dir':
+                self.checkpoint_dir = value
+            if key == 'checkpoint_every':
+                self.checkpoint_every = value
 
@@ -21,10 +21,16 @@ from keras.layers import Dense, Activation
 import tensorflow as tf
 tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
 import os
+import json
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 # Disables the warning "Your CPU supports instructions that this TensorFlow binary was not compiled to use: AVX2 FMA", doesn't enable AVX/FMA
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
 from RobustMMLL.models.POM1.CommonML.POM1_CommonML import POM1_CommonML_Master, POM1_CommonML_Worker
+from RobustMMLL.robust.compression import Update_Compressor, decode_layer, decode_update, is_encoded, layer_shape
+from RobustMMLL.models.POM1.NeuralNetworks.server_optimizer import Server_Optimizer
 
 
 
@@ -76,7 +82,7 @@ class NN_Master(POM1_CommonML_Master):
     """
     This class implements Neural nets, run at Master node. It inherits from POM1_CommonML_Master.
     """
-    def __init__(self, comms, logger, verbose=False, robust=None, model_architecture=None, Nmaxiter=10, learning_rate=0.0001, model_averaging='True', optimizer='adam', loss='categorical_crossentropy', metric='accuracy', batch_size=32, num_epochs=1):
+    def __init__(self, comms, logger, verbose=False, robust=None, model_architecture=None, Nmaxiter=10, learning_rate=0.0001, model_averaging='True', optimizer='adam', loss='categorical_crossentropy', metric='accuracy', batch_size=32, num_epochs=1, async_mode=False, buffer_size=None, staleness_exponent=0.5, round_deadline=None, min_quorum=1, sampling_fraction=1., delta_broadcast=False, compression=None, sparsity=None, sparsification='topk', server_optimizer=None, server_learning_rate=None, server_momentum=0.9, server_beta2=0.99, patience=None, min_delta=0., convergence_tolerance=None, eval_every=1, val_subsample=None, eval_async=False, checkpoint_dir=None, checkpoint_every=1):
         """
         Create a :class:`NN_Master` instance.
 
@@ -120,6 +126,88 @@ class NN_Master(POM1_CommonML_Master):
 
         num_epochs: Int
             Number of epochs to train in each worker locally before sending the result to the master
+
+        async_mode: Boolean
+            If True (only with model averaging), the model is aggregated as soon as buffer_size updates have arrived and the new
+            model is sent only to the workers that reported, while the rest keep training on older versions (buffered asynchronous rounds)
+
+        buffer_size: Int
+            Number of updates aggregated in asynchronous mode. If None, half of the workers
+
+        staleness_exponent: float
+            In asynchronous mode, the update of a worker trained on a model s versions old is scaled by (1 + s)^(-staleness_exponent)
+
+        round_deadline: float
+            Seconds after which a synchronous round is closed with the updates received so far (if at least min_quorum). If None, the
+            round waits for all the workers asked to train. The deadline also applies to the acknowledgements of the setup (training
+            starts with at least min_quorum workers ready) and of the final model (training ends without the missing ones)
+
+        min_quorum: Int
+            Minimum number of updates needed to close a round once the deadline has passed. It is raised to the number of updates
+            the robust aggregation needs (2f + 3 for Krum and Multi-Krum, 4f + 3 for Bulyan)
+
+        sampling_fraction: float
+            Fraction of the workers asked to train in every synchronous round, sampled at random
+
+        delta_broadcast: Boolean
+            If True, every global model is tagged with a version and the workers only receive its difference with the last version
+            they acknowledged (the full model if that version is no longer stored). The workers send back their difference with
+            the model received instead of the full model
+
+        compression: String
+            Compression of the updates sent by the workers: 'float16', 'int8' (stochastic quantization with a scale and zero point
+            per layer) or None
+
+        sparsity: float
+            Fraction of the values of every layer sent by the workers, which keep the rest for the next rounds (error feedback).
+            The workers send their difference with the model received. None to send all the values
+
+        sparsification: String
+            Values sent by the workers when sparsity is set: 'topk' (largest magnitude) or 'randomk' (random)
+
+        server_optimizer: String
+            Optimizer applied to the global model, using its difference with the aggregated model (or the aggregated
+            gradients) as pseudo-gradient: 'sgd', 'momentum' (FedAvgM), 'adam' (FedAdam), 'yogi' (FedYogi) or None to
+            replace the global model by the aggregated one (plain SGD with learning_rate on gradients)
+
+        server_learning_rate: float
+            Learning rate of the server optimizer, if None 1 for model averaging and learning_rate for gradients
+
+        server_momentum: float
+            Decay of the first moment of the pseudo-gradients
+
+        server_beta2: float
+            Decay of the second moment of the pseudo-gradients, only for 'adam' and 'yogi'
+
+        patience: Int
+            Number of iterations without improvement of the validation loss before stopping the training, None to disable
+            early stopping. Iterations are counted from the one whose model gave the best loss, so with eval_every > 1 or
+            eval_async the training stops at the first evaluation at least patience iterations after it
+
+        min_delta: float
+            Minimum decrease of the validation loss counted as an improvement
+
+        convergence_tolerance: float
+            The training stops when the norm of the change of the global model in an iteration, relative to the norm of
+            the model, falls below this value. None to disable
+
+        eval_every: Int
+            The validation set is evaluated every eval_every iterations (and at the last one)
+
+        val_subsample: Int or float
+            Number (int) or fraction (float) of validation patterns evaluated, drawn once per class so that the classes keep
+            their proportions. None to evaluate the whole validation set
+
+        eval_async: Boolean
+            If True, the evaluation runs in a background thread on a copy of the global model, so that the next round
+            starts without waiting for it. Its result is reported (and used by early stopping) one evaluation later
+
+        checkpoint_dir: String
+            Directory where the training state (global model, counters, server optimizer and robust aggregator) is saved,
+            None to disable checkpoints. The training can be resumed from it with `load_checkpoint`
+
+        checkpoint_every: Int
+            The training state is saved every checkpoint_every iterations (and at the last one)
         """
         self.comms = comms    
         self.robust = robust
@@ -134,11 +222,56 @@ class NN_Master(POM1_CommonML_Master):
         self.metric = metric
         self.batch_size = batch_size
         self.num_epochs = num_epochs
+        self.async_mode = async_mode
+        self.staleness_exponent = staleness_exponent
+        self.round_deadline = round_deadline
+        self.min_quorum = max(min_quorum, robust.min_updates()) if robust is not None else min_quorum
+        self.sampling_fraction = sampling_fraction
+        self.delta_broadcast = delta_broadcast
+        self.compression = compression
+        self.sparsity = sparsity
+        self.sparsification = sparsification
+        if server_learning_rate is None:
+            server_learning_rate = 1. if self.model_averaging == 'true' else learning_rate
+        self.patience = patience
+        self.min_delta = min_delta
+        self.convergence_tolerance = convergence_tolerance
+        self.eval_every = eval_every
+        self.val_subsample = val_subsample
+        self.eval_async = eval_async
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_every = checkpoint_every
+        self.server_optimizer = Server_Optimizer(server_optimizer, server_learning_rate, server_momentum, server_beta2) if server_optimizer is not None else None
 
         self.name = 'POM1_NN_Master'                # Name
         self.platform = comms.name                  # Type of comms to use: either 'pycloudmessenger' or 'local_flask'
         self.workers_addresses = comms.workers_ids  # Addresses of the workers
         self.Nworkers = len(self.workers_addresses) # Number of workers
+        self.buffer_size = buffer_size if buffer_size is not None else max(1, self.Nworkers//2)
+        num_round = self.buffer_size if self.async_mode else max(1, int(np.ceil(self.sampling_fraction*self.Nworkers))) # Updates in a complete round
+        if num_round < self.min_quorum:
+            raise ValueError('The rounds gather at most %d updates, fewer than the %d needed (min_quorum or the minimum of the robust aggregation)' %(num_round, self.min_quorum))
+        self.model_version = 0                      # Version of the global model, increased at every aggregation
+        self.worker_versions = {}                   # Version of the global model last sent to every worker
+        self.acked_versions = {}                    # Version of the global model last acknowledged by every worker
+        self.version_weights = {}                   # Global models still held by some worker (asynchronous mode, delta broadcast or sparse updates)
+        self.last_order = None                      # Last order sent with the global model, resent to the workers asking for a resync
+        self.reported_workers = []                  # Workers whose update is waiting to be aggregated (asynchronous mode)
+        self.update_sum = None                      # Running sum of the updates of the round, one array per layer (no robust aggregation)
+        self.num_summed = 0                         # Number of updates in the running sum
+        self.round_id = 0                           # Identifier of the current round, sent with the orders and returned with the updates
+        self.round_workers = self.workers_addresses # Workers asked to train in the current round
+        self.round_start = None                     # Time when the current round (or the wait for acknowledgements) started
+        self.best_loss = np.inf                     # Lowest validation loss so far (early stopping)
+        self.best_iter = 0                          # Iteration whose model gave the lowest validation loss
+        self.update_norm = None                     # Relative norm of the last change of the global model
+        self.training_done = False                  # Flag to know if a stopping criterion was met (also restored from a checkpoint)
+        self.val_subset = None                      # Validation set, or its subsample, actually evaluated
+        self.eval_model = None                      # Copy of the model evaluated in the background, with its own graph and session
+        self.eval_pool = None                       # Background thread running the evaluations
+        self.pending_eval = None                    # Evaluation running in the background, with its iteration
+        self.checkpoint_pool = None                 # Background thread writing the checkpoints
+        self.pending_checkpoint = None              # Checkpoint being written in the background
         self.reset()                                # Reset local data
         self.model = model(model_architecture, self.optimizer, self.loss, self.metric)      # Keras model initialization
         self.display(self.name + ': Model architecture:')
@@ -160,33 +293,31 @@ class NN_Master(POM1_CommonML_Master):
         None
         '''
         if self.state_dict['CN'] == 'START_TRAIN':
-            self.state_dict['CN'] = 'INIT_MODEL'
+            self.state_dict['CN'] = 'SETUP'
+
+        if self.state_dict['CN'] == 'wait' and self.is_trained and self.checkAckStates('ACK_FINAL_MODEL', 0):
+            self.state_dict['CN'] = 'END' # Deadline passed, some workers did not acknowledge the final model
 
         if self.model_averaging == 'true':
-            if self.checkAllStates('ACK_INIT_MODEL', self.state_dict):
+            if self.state_dict['CN'] == 'wait' and not self.is_trained and self.checkAckStates('ACK_SETUP', self.min_quorum):
                 for worker in self.workers_addresses:
                     self.state_dict[worker] = ''
-                self.state_dict['CN'] = 'COMPILE_INIT'
-            if self.checkAllStates('ACK_COMPILE_INIT', self.state_dict):
-                for worker in self.workers_addresses:
-                    self.state_dict[worker] = ''
-                self.state_dict['CN'] = 'FIT_INIT'
-            if self.checkAllStates('ACK_FIT_INIT', self.state_dict):
-                for worker in self.workers_addresses:
-                    self.state_dict[worker] = ''
-                self.state_dict['CN'] = 'LOCAL_TRAIN'
-            if self.checkAllStates('LOCAL_UPDATE', self.state_dict):
+                self.state_dict['CN'] = 'SEND_FINAL_MODEL' if self.training_done else 'LOCAL_TRAIN' # Resumed from the final checkpoint
+            if self.async_mode:
+                if self.state_dict['CN'] == 'wait_weights' and len(self.reported_workers) >= self.buffer_size: # Enough updates buffered
+                    self.state_dict['CN'] = 'MODEL_AVERAGING'
+            elif self.state_dict['CN'] == 'wait_weights' and self.checkRoundStates('LOCAL_UPDATE'):
                 for worker in self.workers_addresses:
                     self.state_dict[worker] = ''
                 self.state_dict['CN'] = 'MODEL_AVERAGING'
 
         else:            
-            if self.checkAllStates('ACK_INIT_MODEL', self.state_dict):
+            if self.state_dict['CN'] == 'wait' and not self.is_trained and self.checkAckStates('ACK_SETUP', self.min_quorum):
                 for worker in self.workers_addresses:
                     self.state_dict[worker] = ''
-                self.state_dict['CN'] = 'COMPUTE_GRADIENTS'
+                self.state_dict['CN'] = 'SEND_FINAL_MODEL' if self.training_done else 'COMPUTE_GRADIENTS' # Resumed from the final checkpoint
 
-            if self.checkAllStates('UPDATE_GRADIENTS', self.state_dict):
+            if self.state_dict['CN'] == 'wait_gradients' and self.checkRoundStates('UPDATE_GRADIENTS'):
                 for worker in self.workers_addresses:
                     self.state_dict[worker] = ''
                 self.state_dict['CN'] = 'UPDATE_MODEL'
@@ -201,25 +332,34 @@ class NN_Master(POM1_CommonML_Master):
         ----------
         None
         """
-        # Send model to all workers
-        if self.state_dict['CN'] == 'INIT_MODEL':
-            action = 'INIT_MODEL'
-            to = 'MLmodel'
-            data = {'model_json': self.model_architecture}
-            packet = {'to': to, 'action': action, 'data': data}
-            self.comms.broadcast(packet, self.workers_addresses)
+        # Send model architecture, compile and fit settings and initial weights to all workers in a single packet
+        if self.state_dict['CN'] == 'SETUP':
+            action = 'SETUP'
+            data = {'model_json': self.model_architecture, 'optimizer': self.optimizer, 'loss': self.loss, 'metric': self.metric,
+                    'batch_size': self.batch_size, 'num_epochs': self.num_epochs, 'compression': self.compression,
+                    'sparsity': self.sparsity, 'sparsification': self.sparsification}
+            self.send_model(action, self.workers_addresses, data)
             self.display(self.name + ': Sent ' + action + ' to all workers')
+            self.round_start = time.time()
             self.state_dict['CN'] = 'wait'
 
         # Compute average of gradients and update model
         if self.state_dict['CN'] == 'UPDATE_MODEL':
-            for index_layer in range(len(self.model.keras_model.get_weights())):
-                layer_gradients = []
-                for worker in range(self.Nworkers):
-                    layer_gradients.append(self.list_gradients[worker][index_layer])                 
-                mean_weights = np.mean(layer_gradients, axis=0) # Average layer gradients for all workers
-                K.set_value(self.model.keras_model.trainable_weights[index_layer], K.get_value(self.model.keras_model.trainable_weights[index_layer]) - self.learning_rate*mean_weights) # Update model weights
-                
+            if self.robust is not None:
+                mean_gradients = self.robust.aggregate() # Aggregate the gradients added as they arrived
+            else:
+                mean_gradients = self.average_updates() # Average of the gradients summed as they arrived
+
+            trainable_weights = self.model.keras_model.trainable_weights
+            current_weights = K.batch_get_value(trainable_weights) # Single backend call for all the layers
+            if self.server_optimizer is not None:
+                new_weights = self.server_optimizer.step(current_weights, mean_gradients)
+            else:
+                new_weights = [value - self.learning_rate*gradient for value, gradient in zip(current_weights, mean_gradients)]
+            K.batch_set_value(list(zip(trainable_weights, new_weights))) # Update model weights in a single call
+            self.update_norm = self.relative_change(current_weights, new_weights)
+            self.model_version += 1
+
             self.reset()
             self.state_dict['CN'] = 'CHECK_TERMINATION'
             self.iter += 1
@@ -227,90 +367,623 @@ class NN_Master(POM1_CommonML_Master):
         # Compute model averaging
         if self.state_dict['CN'] == 'MODEL_AVERAGING':
             if self.robust is not None:
-                new_weights = self.robust.aggregate(self.list_weights) # Update model weights
+                new_weights = self.robust.aggregate() # Aggregate the updates added as they arrived
+                diagnostics = self.robust.diagnostics
+                if 'norm_median' in diagnostics:
+                    self.display(self.name + ': Update norms min %0.4f, median %0.4f, max %0.4f, %d of %d updates clipped' %(diagnostics['norm_min'], diagnostics['norm_median'], diagnostics['norm_max'], diagnostics['num_clipped'], diagnostics['num_updates']))
             else:
-                new_weights = []
-                for index_layer in range(len(self.list_weights[0])):
-                    layer_weights = []
-                    for worker in range(len(self.list_weights)):
-                        layer_weights.append(self.list_weights[worker][index_layer])                 
-                    mean_weights = np.mean(layer_weights, axis=0) # Average layer weights for all workers
-                    new_weights.append(mean_weights)
-
+                new_weights = self.average_updates() # Average of the models summed as they arrived
+
+            if self.server_optimizer is not None or self.convergence_tolerance is not None:
+                current_weights = self.model.keras_model.get_weights()
+            if self.server_optimizer is not None: # The difference with the aggregated model is the pseudo-gradient
+                new_weights = self.server_optimizer.step(current_weights, [current - new for current, new in zip(current_weights, new_weights)])
+            if self.convergence_tolerance is not None:
+                self.update_norm = self.relative_change(current_weights, new_weights)
             self.model.keras_model.set_weights(new_weights)        
+            self.model_version += 1
             self.reset()
             self.state_dict['CN'] = 'CHECK_TERMINATION'
             self.iter += 1
 
         # Check for termination of the training
         if self.state_dict['CN'] == 'CHECK_TERMINATION':
+            loss = None
+            eval_iter = self.iter # Iteration of the model evaluated
+            reported = False
             if self.Xval is not None and self.yval is not None:
-                [loss, accuracy] = self.model.keras_model.evaluate(self.Xval, self.yval, verbose=self.verbose)
-                self.display(self.name + ': Iteration %d, loss: %0.4f val accuracy: %0.4f' %(self.iter, loss, accuracy))
-            if self.iter == self.Nmaxiter:
+                evaluate_now = self.iter % self.eval_every == 0 or self.iter >= self.Nmaxiter
+                if self.eval_async:
+                    eval_iter, loss = self.collect_evaluation(wait=evaluate_now) # Result of the previous evaluation, if already finished
+                    if evaluate_now:
+                        self.start_evaluation()
+                elif evaluate_now:
+                    X, y = self.get_validation_set()
+                    [loss, accuracy] = self.model.keras_model.evaluate(X, y, verbose=self.verbose)
+                    self.display(self.name + ': Iteration %d, loss: %0.4f val accuracy: %0.4f' %(self.iter, loss, accuracy))
+                    reported = True
+            stop_reason = self.check_convergence(loss, eval_iter)
+            self.training_done = self.iter >= self.Nmaxiter or stop_reason is not None
+            if self.checkpoint_dir is not None and (self.iter % self.checkpoint_every == 0 or self.training_done):
+                self.save_checkpoint()
+            if self.training_done:
+                self.collect_evaluation(wait=True) # Report the evaluation of the final model
+                self.wait_checkpoint()
                 self.state_dict['CN'] = 'SEND_FINAL_MODEL'
-                self.display(self.name + ': Stopping training, maximum number of iterations reached!')
+                if stop_reason is None:
+                    self.display(self.name + ': Stopping training, maximum number of iterations reached!')
+                else:
+                    self.display(self.name + ': Stopping training at iteration %d, %s!' %(self.iter, stop_reason))
             else:
                 if self.model_averaging == 'true':
                     self.state_dict['CN'] = 'LOCAL_TRAIN' 
                 else:
                     self.state_dict['CN'] = 'COMPUTE_GRADIENTS'           
-                if self.Xval is None or self.yval is None:
+                if not reported:
                     self.display(self.name + ': Iteration %d' %self.iter)
 
         # Asking the workers to compute local gradients
         if self.state_dict['CN'] == 'COMPUTE_GRADIENTS':
             action = 'COMPUTE_LOCAL_GRADIENTS'
-            to = 'MLmodel'
-            data = {'model_weights': self.model.keras_model.get_weights()}
-            packet = {'to': to, 'action': action, 'data': data}
-            self.comms.broadcast(packet, self.workers_addresses)
-            self.display(self.name + ': Sent ' + action + ' to all workers')
+            recipients = self.start_round()
+            if self.robust is not None:
+                self.robust.set_reference([np.zeros(K.int_shape(variable), dtype=K.dtype(variable)) for variable in self.model.keras_model.trainable_weights]) # Gradients are compared with a null step
+                self.robust.allocate(len(recipients))
+            self.send_model(action, recipients, {'round': self.round_id})
+            self.display(self.name + ': Sent ' + action + ' to %d workers' %len(recipients))
             self.state_dict['CN'] = 'wait_gradients'
 
-        # Asking the workers to compile the model
-        if self.state_dict['CN'] == 'COMPILE_INIT':
-            action = 'COMPILE_INIT'
-            to = 'MLmodel'
-            data = {'optimizer': self.optimizer, 'loss': self.loss, 'metric': self.metric}
-            packet = {'to': to, 'action': action, 'data': data}
-            self.comms.broadcast(packet, self.workers_addresses)
-            self.display(self.name + ': Sent ' + action + ' to all workers')
-            self.state_dict['CN'] = 'wait'
-
-        # Asking the workers to initialize fit parameters
-        if self.state_dict['CN'] == 'FIT_INIT':
-            action = 'FIT_INIT'
-            to = 'MLmodel'
-            data = {'batch_size': self.batch_size, 'num_epochs': self.num_epochs}
-            packet = {'to': to, 'action': action, 'data': data}
-            self.comms.broadcast(packet, self.workers_addresses)
-            self.display(self.name + ': Sent ' + action + ' to all workers')
-            self.state_dict['CN'] = 'wait'
-
         # Asking the workers to update model with local data
         if self.state_dict['CN'] == 'LOCAL_TRAIN':
             action = 'LOCAL_TRAIN'
-            to = 'MLmodel'
-            data = {'model_weights': self.model.keras_model.get_weights()}
-            packet = {'to': to, 'action': action, 'data': data}
-            self.comms.broadcast(packet, self.workers_addresses)
-            self.display(self.name + ': Sent ' + action + ' to all workers')
+            recipients = self.workers_addresses if self.async_mode else self.start_round()
+            model_weights = self.model.keras_model.get_weights()
+            if self.robust is not None:
+                self.robust.set_reference(model_weights) # Global model the updates are compared with
+                self.robust.allocate(self.Nworkers)      # Room for the updates of all the workers
+            if self.async_mode:
+                if len(self.reported_workers) > 0: # Only the workers whose update was aggregated are idle
+                    recipients = self.reported_workers
+                for worker in recipients:
+                    self.state_dict[worker] = ''
+                self.reported_workers = []
+            self.send_model(action, recipients, {'round': self.round_id}, model_weights)
+            self.display(self.name + ': Sent ' + action + ' to %d workers' %len(recipients))
             self.state_dict['CN'] = 'wait_weights'
         
         # Send final model to all workers
         if self.state_dict['CN'] == 'SEND_FINAL_MODEL':
             action = 'SEND_FINAL_MODEL'
-            to = 'MLmodel'
-            data = {'model_weights': self.model.keras_model.get_weights()}
-            packet = {'to': to, 'action': action, 'data': data}
-            self.comms.broadcast(packet, self.workers_addresses)
+            self.send_model(action, self.workers_addresses)
             self.display(self.name + ': Sent %s to all workers' %action)
             self.is_trained = True
+            self.round_start = time.time()
             self.state_dict['CN'] = 'wait'
             
 
 
+    def send_model(self, action, recipients, data=None, model_weights=None):
+        """
+        Send an order together with the current global model to some workers. With delta broadcast, the workers are grouped
+        by the version they acknowledged last and every group only receives the difference with that version
+
+        Parameters
+        ----------
+        action: String
+            Order sent to the workers
+
+        recipients: List of strings
+            Addresses of the workers
+
+        data: Dictionary
+            Additional data sent with the order
+
+        model_weights: List of numpy arrays
+            Current global model. If None, it is taken from the Keras model
+        """
+        data = data if data is not None else {}
+        model_weights = model_weights if model_weights is not None else self.model.keras_model.get_weights()
+        self.last_order = (action, data)
+        if self.async_mode or self.delta_broadcast or self.sparsity is not None:
+            self.version_weights[self.model_version] = model_weights
+            for worker in recipients:
+                self.worker_versions[worker] = self.model_version
+            held_versions = set(self.worker_versions.values()) | set(self.acked_versions.values()) if self.delta_broadcast else set(self.worker_versions.values())
+            self.version_weights = {version: self.version_weights[version] for version in (held_versions | {self.model_version}) & set(self.version_weights)} # Drop the versions no worker holds
+
+        if not self.delta_broadcast:
+            if self.sparsity is not None: # The workers send back sparse differences with this version
+                data = dict(data, version=self.model_version)
+            packet = {'to': 'MLmodel', 'action': action, 'data': dict(data, model_weights=model_weights)}
+            self.comms.broadcast(packet, recipients)
+            return
+
+        groups = {}
+        for worker in recipients:
+            groups.setdefault(self.acked_versions.get(worker), []).append(worker)
+        for version, workers in groups.items():
+            group_data = dict(data, version=self.model_version)
+            if version in self.version_weights:
+                group_data['base_version'] = version
+                group_data['model_delta'] = [current - base for current, base in zip(model_weights, self.version_weights[version])]
+            else: # Unknown or dropped version, full resync
+                group_data['model_weights'] = model_weights
+            packet = {'to': 'MLmodel', 'action': action, 'data': group_data}
+            self.comms.broadcast(packet, workers)
+
+
+
+    def get_received_update(self, data, worker):
+        """
+        Update sent by a worker, either its model or, when delta broadcast is used, its difference with the version it
+        received together with that version. The layers may be compressed
+
+        Parameters
+        ----------
+        data: Dictionary
+            Data of the LOCAL_UPDATE packet
+
+        worker: String
+            Id of the worker
+
+        Returns
+        ----------
+        weights: List of numpy arrays or Dictionaries
+            Model trained by the worker, or its difference with the base model
+
+        base: List of numpy arrays
+            Model the difference refers to, or None
+        """
+        if 'version' in data:
+            self.acked_versions[worker] = data['version']
+        if 'delta' in data:
+            return data['delta'], self.version_weights[data['version']]
+        return data['weights'], None
+
+
+
+    def sum_update(self, weights, base=None):
+        """
+        Add an update to the running sum of the round, decoding every layer straight into it, so that the updates
+        of the workers are never stored (used when there is no robust aggregation)
+
+        Parameters
+        ----------
+        weights: List of numpy arrays or Dictionaries
+            Update of a worker, with every layer either encoded or not
+
+        base: List of numpy arrays
+            If not None, the update is the difference with this model, which is added to it
+        """
+        if self.update_sum is None: # Allocated once, reused in every round
+            self.update_sum = [np.zeros(layer_shape(layer), dtype=np.result_type(layer['dtype'] if is_encoded(layer) else layer, np.float32)) for layer in weights]
+        for index_layer, layer in enumerate(weights):
+            layer_sum = self.update_sum[index_layer].reshape(-1)
+            if base is not None:
+                layer_sum += np.ravel(base[index_layer])
+            decode_layer(layer, layer_sum)
+        self.num_summed += 1
+
+
+
+    def average_updates(self):
+        """
+        Average of the updates summed in the round, the running sum is cleared for the next round
+
+        Returns
+        ----------
+        mean_weights: List of numpy arrays
+            Average of the updates, one array per layer
+        """
+        mean_weights = [layer_sum / self.num_summed for layer_sum in self.update_sum]
+        for layer_sum in self.update_sum:
+            layer_sum.fill(0)
+        self.num_summed = 0
+        return mean_weights
+
+
+
+    def get_validation_set(self):
+        """
+        Validation patterns evaluated at every evaluation: the whole validation set, or a stratified subsample drawn once
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        ----------
+        X: ndarray
+            Validation patterns
+
+        y: ndarray
+            Validation targets
+        """
+        if self.val_subset is not None and self.val_subset[0] is self.Xval:
+            return self.val_subset[1], self.val_subset[2]
+        X, y = self.Xval, self.yval
+        num_val = X.shape[0]
+        if self.val_subsample is not None:
+            num_selected = int(round(self.val_subsample*num_val)) if isinstance(self.val_subsample, float) else int(self.val_subsample)
+            if num_selected < num_val:
+                labels = np.argmax(y, axis=1) if y.ndim > 1 and y.shape[1] > 1 else np.ravel(y)
+                random_state = np.random.RandomState(0) # The same subsample in every evaluation
+                indices = []
+                for label in np.unique(labels):
+                    class_indices = np.flatnonzero(labels == label)
+                    num_class = min(class_indices.size, max(1, int(round(class_indices.size*num_selected/float(num_val)))))
+                    indices.append(random_state.choice(class_indices, num_class, replace=False))
+                indices = np.sort(np.concatenate(indices))
+                X, y = X[indices], y[indices]
+                self.display(self.name + ': Evaluating on a stratified subsample of %d of %d validation patterns' %(indices.size, num_val))
+        self.val_subset = (self.Xval, X, y)
+        return X, y
+
+
+
+    def start_evaluation(self):
+        """
+        Start the evaluation of a copy of the current global model in the background thread. The copy of the model used
+        has its own graph and session, so that it does not interfere with the global model
+
+        Parameters
+        ----------
+        None
+        """
+        if self.eval_model is None:
+            self.eval_graph = tf.Graph()
+            with self.eval_graph.as_default():
+                self.eval_session = tf.compat.v1.Session(graph=self.eval_graph)
+                with self.eval_session.as_default():
+                    self.eval_model = model(self.model_architecture, self.optimizer, self.loss, self.metric)
+            self.eval_pool = ThreadPoolExecutor(max_workers=1)
+        X, y = self.get_validation_set()
+        weights = self.model.keras_model.get_weights() # Snapshot of the global model
+
+        def evaluate():
+            with self.eval_graph.as_default(), self.eval_session.as_default():
+                self.eval_model.keras_model.set_weights(weights)
+                return self.eval_model.keras_model.evaluate(X, y, verbose=0)
+
+        self.pending_eval = (self.iter, self.eval_pool.submit(evaluate))
+
+
+
+    def collect_evaluation(self, wait=False):
+        """
+        Report the result of the evaluation running in the background
+
+        Parameters
+        ----------
+        wait: Boolean
+            If True, wait for the evaluation to finish. Otherwise, it is only collected if already finished
+
+        Returns
+        ----------
+        iteration: Int
+            Iteration of the model evaluated, None if there is no finished evaluation
+
+        loss: float
+            Validation loss, None if there is no finished evaluation
+        """
+        if self.pending_eval is None or not (wait or self.pending_eval[1].done()):
+            return None, None
+        iteration, future = self.pending_eval
+        self.pending_eval = None
+        [loss, accuracy] = future.result()
+        self.display(self.name + ': Iteration %d, loss: %0.4f val accuracy: %0.4f (evaluated in background)' %(iteration, loss, accuracy))
+        return iteration, loss
+
+
+
+    def get_checkpoint_path(self, path=None):
+        """
+        Path of the checkpoint file
+
+        Parameters
+        ----------
+        path: String
+            Path of the checkpoint file or of its directory. If None, checkpoint_dir is used
+
+        Returns
+        ----------
+        path: String
+            Path of the checkpoint file
+        """
+        path = path if path is not None else self.checkpoint_dir
+        if path is None:
+            raise ValueError('No checkpoint path given and checkpoint_dir is not set')
+        return os.path.join(path, 'checkpoint.npz') if os.path.isdir(path) or not path.endswith('.npz') else path
+
+
+
+    def save_checkpoint(self):
+        """
+        Save the training state: global model, counters, early stopping, server optimizer and robust aggregator. The state
+        is copied and then written in a background thread, at most one checkpoint is being written at any time
+
+        Parameters
+        ----------
+        None
+        """
+        meta = {'iter': self.iter, 'model_version': self.model_version, 'round_id': self.round_id, 'best_loss': float(self.best_loss),
+                'best_iter': self.best_iter, 'update_norm': self.update_norm, 'training_done': self.training_done}
+        weights = self.model.keras_model.get_weights() # Copies of the weights
+        arrays = {'weights/%d' %index_layer: layer for index_layer, layer in enumerate(weights)}
+        meta['num_layers'] = len(weights)
+        states = [('server_optimizer', self.server_optimizer), ('robust', self.robust)]
+        for prefix, component in states:
+            if component is None or not hasattr(component, 'get_state'):
+                continue
+            for key, value in component.get_state().items():
+                if isinstance(value, np.ndarray):
+                    arrays[prefix + '/' + key] = value
+                else:
+                    meta[prefix + '/' + key] = value
+        arrays['meta'] = np.array(json.dumps(meta))
+
+        self.wait_checkpoint() # Surface the errors of the previous write
+        if self.checkpoint_pool is None:
+            if not os.path.isdir(self.checkpoint_dir):
+                os.makedirs(self.checkpoint_dir)
+            self.checkpoint_pool = ThreadPoolExecutor(max_workers=1)
+        self.pending_checkpoint = self.checkpoint_pool.submit(self.write_checkpoint, self.get_checkpoint_path(), arrays)
+
+
+
+    def write_checkpoint(self, path, arrays):
+        """
+        Write a checkpoint atomically: the arrays are saved (uncompressed) to a temporary file in the same directory, which
+        then replaces the previous checkpoint, so that a crash never leaves a partial checkpoint
+
+        Parameters
+        ----------
+        path: String
+            Path of the checkpoint file
+
+        arrays: Dictionary
+            Arrays to save
+        """
+        handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as temp_file:
+                np.savez(temp_file, **arrays)
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+            os.replace(temp_path, path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+
+
+    def wait_checkpoint(self):
+        """
+        Wait for the checkpoint being written in the background, if any
+
+        Parameters
+        ----------
+        None
+        """
+        if self.pending_checkpoint is not None:
+            future, self.pending_checkpoint = self.pending_checkpoint, None
+            future.result()
+            self.display(self.name + ': Checkpoint saved at %s' %self.get_checkpoint_path())
+
+
+
+    def load_checkpoint(self, path=None):
+        """
+        Restore the training state saved by `save_checkpoint`. The training then continues from the iteration after the
+        checkpoint, and the workers receive the full global model with the SETUP order
+
+        Parameters
+        ----------
+        path: String
+            Path of the checkpoint file or of its directory. If None, checkpoint_dir is used
+        """
+        path = self.get_checkpoint_path(path)
+        with np.load(path) as checkpoint:
+            meta = json.loads(str(checkpoint['meta']))
+            weights = [checkpoint['weights/%d' %index_layer] for index_layer in range(meta['num_layers'])]
+            states = {}
+            for key in checkpoint.files:
+                if '/' in key and not key.startswith('weights/'):
+                    prefix, name = key.split('/', 1)
+                    states.setdefault(prefix, {})[name] = checkpoint[key]
+        for key, value in meta.items():
+            if '/' in key:
+                prefix, name = key.split('/', 1)
+                states.setdefault(prefix, {})[name] = value
+
+        self.model.keras_model.set_weights(weights)
+        self.iter = meta['iter']
+        self.model_version = meta['model_version']
+        self.round_id = meta['round_id']
+        self.best_loss = meta['best_loss']
+        self.best_iter = meta['best_iter']
+        self.update_norm = meta['update_norm']
+        self.training_done = meta.get('training_done', self.iter >= self.Nmaxiter)
+        if self.server_optimizer is not None and 'server_optimizer' in states:
+            self.server_optimizer.set_state(states['server_optimizer'])
+        if self.robust is not None and hasattr(self.robust, 'set_state') and 'robust' in states:
+            self.robust.set_state(states['robust'])
+        self.version_weights = {}  # The workers do not hold any version of the restored model
+        self.worker_versions = {}
+        self.acked_versions = {}
+        if self.training_done:
+            self.display(self.name + ': Training already finished at iteration %d (checkpoint %s), sending the final model' %(self.iter, path))
+        else:
+            self.display(self.name + ': Resuming training from iteration %d (checkpoint %s)' %(self.iter, path))
+
+
+
+    def relative_change(self, current_weights, new_weights):
+        """
+        Norm of the change of the global model relative to the norm of the model
+
+        Parameters
+        ----------
+        current_weights: List of numpy arrays
+            Global model before the update
+
+        new_weights: List of numpy arrays
+            Global model after the update
+
+        Returns
+        ----------
+        update_norm: float
+            Relative norm of the change
+        """
+        sq_change = 0.
+        sq_norm = 0.
+        for current, new in zip(current_weights, new_weights):
+            change = np.ravel(new) - np.ravel(current)
+            sq_change += np.dot(change, change)
+            sq_norm += np.dot(np.ravel(current), np.ravel(current))
+        return float(np.sqrt(sq_change / max(sq_norm, 1e-12)))
+
+
+
+    def check_convergence(self, loss=None, iteration=None):
+        """
+        Check the early stopping criteria: the validation loss has not improved by more than min_delta in patience
+        iterations, or the change of the global model in the last iteration is below convergence_tolerance
+
+        Parameters
+        ----------
+        loss: float
+            Validation loss, None if no evaluation finished in this iteration
+
+        iteration: Int
+            Iteration of the model evaluated (earlier than the current one with eval_async). If None, the current one
+
+        Returns
+        ----------
+        stop_reason: String
+            Reason to stop the training, None to continue
+        """
+        if self.convergence_tolerance is not None and self.update_norm is not None and self.update_norm < self.convergence_tolerance:
+            return 'relative model change %0.2e below tolerance %0.2e' %(self.update_norm, self.convergence_tolerance)
+        if self.patience is not None and loss is not None:
+            iteration = iteration if iteration is not None else self.iter
+            if loss < self.best_loss - self.min_delta:
+                self.best_loss = loss
+                self.best_iter = iteration
+            elif iteration - self.best_iter >= self.patience:
+                return 'validation loss did not improve in %d iterations (best %0.4f at iteration %d)' %(iteration - self.best_iter, self.best_loss, self.best_iter)
+        return None
+
+
+
+    def start_round(self):
+        """
+        Start a new synchronous round, sampling the workers asked to train in it
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        ----------
+        round_workers: List of strings
+            Addresses of the workers asked to train in the round
+        """
+        self.round_id += 1
+        self.round_start = time.time()
+        num_sampled = max(1, int(np.ceil(self.sampling_fraction*self.Nworkers)))
+        if num_sampled < self.Nworkers:
+            self.round_workers = [self.workers_addresses[index] for index in np.sort(np.random.choice(self.Nworkers, num_sampled, replace=False))]
+        else:
+            self.round_workers = self.workers_addresses
+        return self.round_workers
+
+
+
+    def checkRoundStates(self, condition):
+        """
+        Checks if the current round can be closed: either all the workers asked to train in the round satisfy a given
+        condition, or the deadline has passed and at least min_quorum of them do
+
+        Parameters
+        ----------
+        condition: String
+            Condition to check
+
+        Returns
+        ----------
+        round_closed: Boolean
+            Flag indicating if the round can be closed
+        """
+        num_received = sum(self.state_dict[worker] == condition for worker in self.round_workers)
+        if num_received == len(self.round_workers):
+            return True
+        if self.round_deadline is not None and time.time() - self.round_start > self.round_deadline and num_received >= self.min_quorum:
+            stragglers = [worker for worker in self.round_workers if self.state_dict[worker] != condition]
+            self.display(self.name + ': Round %d deadline passed, aggregating %d updates without workers %s' %(self.round_id, num_received, ', '.join(stragglers)))
+            return True
+        return False
+
+
+
+    def checkAckStates(self, condition, quorum):
+        """
+        Checks if the master can stop waiting for an acknowledgement: either all the workers sent it, or the deadline has
+        passed and at least quorum of them did
+
+        Parameters
+        ----------
+        condition: String
+            Acknowledgement to check
+
+        quorum: Int
+            Minimum number of acknowledgements needed once the deadline has passed
+
+        Returns
+        ----------
+        wait_done: Boolean
+            Flag indicating if the master can go on
+        """
+        num_received = sum(self.state_dict[worker] == condition for worker in self.workers_addresses)
+        if num_received == self.Nworkers:
+            return True
+        if self.round_deadline is not None and time.time() - self.round_start > self.round_deadline and num_received >= quorum:
+            missing = [worker for worker in self.workers_addresses if self.state_dict[worker] != condition]
+            self.display(self.name + ': Deadline passed, going on with %d %s without workers %s' %(num_received, condition, ', '.join(missing)))
+            return True
+        return False
+
+
+
+    def rebase_update(self, weights, worker):
+        """
+        Rebase the model trained by a worker on an older version of the global model onto the current one, scaling
+        down its update according to the number of versions it is behind
+
+        Parameters
+        ----------
+        weights: List of numpy arrays
+            Model trained by the worker
+
+        worker: String
+            Id of the worker
+
+        Returns
+        ----------
+        new_weights: List of numpy arrays
+            Current global model plus the scaled update of the worker
+        """
+        version = self.worker_versions[worker]
+        staleness = self.model_version - version
+        if staleness > 0:
+            self.display(self.name + ': Update from worker %s is %d versions old' %(worker, staleness))
+        scale = (1. + staleness)**(-self.staleness_exponent)
+        current_weights = self.version_weights[self.model_version]
+        base_weights = self.version_weights[version]
+        return [current + scale*(layer - base) for current, layer, base in zip(current_weights, weights, base_weights)]
+
+
+
     def ProcessReceivedPacket_Master(self, packet, sender):
         """
         Process the received packet at Master and take some actions, possibly changing the state
@@ -323,19 +996,49 @@ class NN_Master(POM1_CommonML_Master):
         sender: Strings
             Id of the sender
         """
+        if packet['action'] == 'RESYNC': # The worker does not hold the version the delta refers to, resend the last order with the full model
+            self.display(self.name + ': Worker %s asked for a full model' %sender)
+            self.acked_versions.pop(sender, None)
+            action, data = self.last_order
+            self.send_model(action, [sender], data)
+            return
+
         if packet['action'][0:3] == 'ACK':
+            if 'data' in packet and 'version' in packet['data']:
+                self.acked_versions[sender] = packet['data']['version']
             self.state_dict[sender] = packet['action']
             if self.checkAllStates('ACK_FINAL_MODEL', self.state_dict): # Included here to avoid calling CheckNewPacket_Master after sending the final model (this call could imply significant delay if timeout is set to a high value)
                 self.state_dict['CN'] = 'END'
 
+        if packet['action'] in ['LOCAL_UPDATE', 'UPDATE_GRADIENTS'] and not self.async_mode and packet['data'].get('round', self.round_id) != self.round_id:
+            self.display(self.name + ': Discarded %s from worker %s, it belongs to round %d' %(packet['action'], sender, packet['data']['round']))
+            if 'version' in packet['data']:
+                if packet['data']['version'] in self.version_weights:
+                    self.acked_versions[sender] = packet['data']['version']
+                else: # Version already dropped, the worker will receive the full model
+                    self.acked_versions.pop(sender, None)
+            return
+
         if self.state_dict['CN'] == 'wait_gradients':
             if packet['action'] == 'UPDATE_GRADIENTS':
-                self.list_gradients.append(packet['data']['gradients'])
+                if 'version' in packet['data']:
+                    self.acked_versions[sender] = packet['data']['version']
+                if self.robust is not None:
+                    self.robust.add_update(packet['data']['gradients'], 1, sender) # Pack (and decode) the gradients while waiting for the rest of workers
+                else:
+                    self.sum_update(packet['data']['gradients']) # Decode the gradients straight into the running sum
                 self.state_dict[sender] = packet['action']
 
         if self.state_dict['CN'] == 'wait_weights':
             if packet['action'] == 'LOCAL_UPDATE':
-                self.list_weights.append(packet['data']['weights'])
+                weights, base = self.get_received_update(packet['data'], sender)
+                if self.async_mode:
+                    weights, base = self.rebase_update(decode_update(weights, base), sender), None
+                    self.reported_workers.append(sender)
+                if self.robust is not None:
+                    self.robust.add_update(weights, packet['data'].get('num_samples', 1), sender, base) # Pack (or fold) the update while waiting for the rest of workers, decoding it straight into the buffer
+                else:
+                    self.sum_update(weights, base)
                 self.state_dict[sender] = packet['action']
   
     
@@ -351,7 +1054,7 @@ class NN_Worker(POM1_CommonML_Worker):
 
     '''
 
-    def __init__(self, master_address, comms, logger, verbose=False, Xtr_b=None, ytr=None):
+    def __init__(self, master_address, comms, logger, verbose=False, Xtr_b=None, ytr=None, robust=None):
         """
         Create a :class:`NN_Worker` instance.
 
@@ -374,6 +1077,9 @@ class NN_Worker(POM1_CommonML_Worker):
 
         ytr: np.ndarray
             2-D numpy array containing the labels for training
+
+        robust: Robust_Worker object instance
+            Object providing robust functionalities
         """
         self.master_address = master_address
         self.comms = comms
@@ -381,6 +1087,7 @@ class NN_Worker(POM1_CommonML_Worker):
         self.verbose = verbose
         self.Xtr_b = Xtr_b
         self.ytr = ytr
+        self.robust = robust
 
         self.name = 'POM1_NN_Worker'                           # Name
         self.worker_address = comms.id
@@ -390,6 +1097,16 @@ class NN_Worker(POM1_CommonML_Worker):
         init = tf.compat.v1.global_variables_initializer()     # Initialize variables
         self.sess.run(init)                                    # Start TF session
         self.is_trained = False                                # Flag to know if the model has been trained
+        self.model_version = None                              # Version of the last global model received (delta broadcast)
+        self.global_weights = None                             # Last global model received (delta broadcast)
+        self.compressor = Update_Compressor()                  # Compression of the updates, set by the master
+
+        if self.robust is not None and self.robust.outlier_method is not None:
+            inliers = self.robust.prefilter_outliers(self.Xtr_b, self.ytr) # Filter the training data once, before any local training
+            if not np.all(inliers):
+                self.Xtr_b = self.robust.select_rows(self.Xtr_b, inliers) # Copied chunk by chunk if memory-mapped
+                self.ytr = self.ytr[inliers]
+            self.display(self.name + ' %s: Prefiltering removed %d of %d training patterns' %(self.worker_address, inliers.size - np.count_nonzero(inliers), inliers.size))
         
         
 
@@ -409,18 +1126,33 @@ class NN_Worker(POM1_CommonML_Worker):
         if packet['action'] == 'STOP':
             self.display(self.name + ' %s: terminated by Master' %self.worker_address)
             self.terminate = True
+
+        if 'data' in packet and 'model_delta' in packet['data'] and packet['data']['base_version'] != self.model_version:
+            self.display(self.name + ' %s: Received a delta from version %s but holding version %s, asking for a resync' %(self.worker_address, packet['data']['base_version'], self.model_version))
+            action = 'RESYNC'
+            packet = {'action': action, 'data': {'version': self.model_version}}
+            self.comms.send(packet, self.master_address)
+            self.display(self.name + ' %s: Sent %s to master' %(self.worker_address, action))
+            return
         
+        if packet['action'] == 'SETUP':
+            self.display(self.name + ' %s: Initializing, compiling and setting the initial weights of the local model' %self.worker_address)
+            data = packet['data']
+            self.init_model(data['model_json'], data['optimizer'], data['loss'], data['metric'])
+            self.model.keras_model.set_weights(self.get_model_weights(data))
+            self.batch_size = data['batch_size']
+            self.num_epochs = data['num_epochs']
+            self.compressor = Update_Compressor(data.get('compression'), data.get('sparsity'), data.get('sparsification', 'topk'))
+            action = 'ACK_SETUP'
+            packet = {'action': action}
+            if 'version' in data:
+                packet['data'] = {'version': data['version']}
+            self.comms.send(packet, self.master_address)
+            self.display(self.name + ' %s: Sent %s to master' %(self.worker_address, action))
+
         if packet['action'] == 'INIT_MODEL':
             self.display(self.name + ' %s: Initializing local model' %self.worker_address)
-            model_json = packet['data']['model_json']
-            # Initialize local model
-            self.current_index = 0
-            self.model = model(model_json)
-            self.display(self.name + ': Model architecture:')
-            self.model.keras_model.summary(print_fn=self.display)
-            self.label_placeholder = tf.compat.v1.placeholder(tf.float32, shape=[None, self.num_classes])
-            self.loss = losses.categorical_crossentropy(self.label_placeholder, self.model.keras_model.output)
-            self.gradients = K.gradients(self.loss, self.model.keras_model.trainable_weights)
+            self.init_model(packet['data']['model_json'])
             action = 'ACK_INIT_MODEL'
             packet = {'action': action}
             self.comms.send(packet, self.master_address)
@@ -449,26 +1181,36 @@ class NN_Worker(POM1_CommonML_Worker):
 
         if packet['action'] == 'LOCAL_TRAIN':
             self.display(self.name + ' %s: Updating model locally' %self.worker_address)
-            weights = packet['data']['model_weights']
+            weights = self.get_model_weights(packet['data'])
             self.model.keras_model.set_weights(weights)
-            self.model.keras_model.fit(self.Xtr_b, self.ytr, epochs=self.num_epochs, batch_size=self.batch_size, verbose=1)
+            if self.robust is not None and self.robust.adversarial_method is not None:
+                self.adversarial_fit()
+            else:
+                self.model.keras_model.fit(self.Xtr_b, self.ytr, epochs=self.num_epochs, batch_size=self.batch_size, verbose=1)
             action = 'LOCAL_UPDATE'
-            data = {'weights': self.model.keras_model.get_weights()}
+            data = {'num_samples': self.Xtr_b.shape[0], 'round': packet['data'].get('round')}
+            if 'version' in packet['data']: # Send only the difference with the model received
+                data['delta'] = self.compressor.encode([new - old for new, old in zip(self.model.keras_model.get_weights(), weights)])
+                data['version'] = packet['data']['version']
+            else:
+                data['weights'] = self.compressor.encode(self.model.keras_model.get_weights())
             packet = {'action': action, 'data': data}            
             self.comms.send(packet, self.master_address)
             self.display(self.name + ' %s: Sent %s to master' %(self.worker_address, action))
             
         if packet['action'] == 'COMPUTE_LOCAL_GRADIENTS':
             self.display(self.name + ' %s: Computing local gradients' %self.worker_address)
-            gradients = self.get_weight_grad(packet['data']['model_weights'], num_data=500)
+            gradients = self.get_weight_grad(self.get_model_weights(packet['data']), num_data=500)
             action = 'UPDATE_GRADIENTS'
-            data = {'gradients': gradients}
+            data = {'gradients': self.compressor.encode(gradients), 'round': packet['data'].get('round')}
+            if 'version' in packet['data']:
+                data['version'] = packet['data']['version']
             packet = {'action': action, 'data': data}            
             self.comms.send(packet, self.master_address)
             self.display(self.name + ' %s: Sent %s to master' %(self.worker_address, action))
             
         if packet['action'] == 'SEND_FINAL_MODEL':            
-            model_weights = packet['data']['model_weights']
+            model_weights = self.get_model_weights(packet['data'])
             self.model.keras_model.set_weights(model_weights)
             self.display(self.name + ' %s: Final model stored' %self.worker_address)
             [_, accuracy] = self.model.keras_model.evaluate(self.Xtr_b, self.ytr, verbose=self.verbose)
@@ -497,3 +1239,90 @@ class NN_Worker(POM1_CommonML_Worker):
         output_grad = self.sess.run(self.gradients, feed_dict={self.label_placeholder: y_batch, self.model.keras_model.input: x_batch})
 
         return output_grad
+
+
+
+    def get_model_weights(self, data):
+        """
+        Global model received from the master, either complete or as the difference with the version held by the worker
+
+        Parameters
+        ----------
+        data: Dictionary
+            Data of the packet received
+
+        Returns
+        ----------
+        model_weights: List of numpy arrays
+            Global model
+        """
+        if 'model_delta' in data:
+            model_weights = [base + delta for base, delta in zip(self.global_weights, data['model_delta'])]
+        else:
+            model_weights = data['model_weights']
+        if 'version' in data:
+            self.model_version = data['version']
+            self.global_weights = model_weights
+        return model_weights
+
+
+
+    def init_model(self, model_json, optimizer='Adam', loss='categorical_crossentropy', metric='accuracy'):
+        """
+        Initializes the local model and the symbolic gradients used by the worker
+
+        Parameters
+        ----------
+        model_json: JSON
+            JSON containing the neural network architecture as defined by Keras (in model.to_json())
+        optimizer: String
+            Type of optimizer to use
+        loss: String
+            Type of loss to use
+        metric: String
+            Type of metric to use
+        """
+        self.current_index = 0
+        self.model = model(model_json, optimizer, loss, metric)
+        self.display(self.name + ': Model architecture:')
+        self.model.keras_model.summary(print_fn=self.display)
+        self.label_placeholder = tf.compat.v1.placeholder(tf.float32, shape=[None, self.num_classes])
+        self.loss = losses.categorical_crossentropy(self.label_placeholder, self.model.keras_model.output)
+        self.gradients = K.gradients(self.loss, self.model.keras_model.trainable_weights)
+        self.input_gradients = K.gradients(self.loss, self.model.keras_model.input)[0] # Reused to generate adversarial samples
+
+
+
+    def get_input_grad(self, x_batch, y_batch):
+        """ Gets gradient of the loss with respect to the inputs of the model for a batch of inputs and outputs"""
+        return self.sess.run(self.input_gradients, feed_dict={self.label_placeholder: y_batch, self.model.keras_model.input: x_batch})
+
+
+
+    def adversarial_fit(self):
+        """
+        Trains the local model with adversarial samples generated by the robust object. In lazy mode, a fraction of every
+        batch is replaced by its adversarial samples inside the training loop, otherwise an adversarial copy of the
+        training data is appended to it.
+
+        Parameters
+        ----------
+        None
+        """
+        if not self.robust.lazy:
+            X_adversarial = self.robust.generate_samples(self.Xtr_b, self.ytr, self.get_input_grad, self.batch_size)
+            self.model.keras_model.fit(np.concatenate((self.Xtr_b, X_adversarial)), np.concatenate((self.ytr, self.ytr)), epochs=self.num_epochs, batch_size=self.batch_size, verbose=1)
+            return
+
+        num_data = self.Xtr_b.shape[0]
+        for epoch in range(self.num_epochs):
+            permutation = np.random.permutation(num_data)
+            for start in range(0, num_data, self.batch_size):
+                data_indexes = np.sort(permutation[start:start+self.batch_size])
+                x_batch = np.take(self.Xtr_b, data_indexes, axis=0).astype(K.floatx(), copy=False)
+                y_batch = np.take(self.ytr, data_indexes, axis=0)
+                num_adversarial = int(round(self.robust.adversarial_fraction*len(data_indexes)))
+                if num_adversarial > 0:
+                    x_batch[:num_adversarial] = self.robust.generate_samples(x_batch[:num_adversarial], y_batch[:num_adversarial], self.get_input_grad)
+                [loss, metric] = self.model.keras_model.train_on_batch(x_batch, y_batch)
+            self.display(self.name + ' %s: Epoch %d, loss: %0.4f' %(self.worker_address, epoch+1, loss))
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+'''
+Optimizers applied by the master to the aggregated updates
+'''
+
+__author__ = "Marcos Fernández Díaz"
+__date__ = "September 2020"
+
+
+import numpy as np
+
+
+
+class Server_Optimizer:
+    """
+    This class implements the server optimizers of adaptive federated optimization, runs at Master node. The
+    difference between the global model and the aggregated model (or the aggregated gradients) is used as a
+    pseudo-gradient, and a step of momentum SGD (FedAvgM), Adam (FedAdam) or Yogi (FedYogi) is applied to the
+    global model. The state of the optimizer is kept in flat arrays allocated once, one segment per layer.
+    """
+    def __init__(self, method='momentum', learning_rate=1., momentum=0.9, beta2=0.99, epsilon=1e-3):
+        """
+        Create a class `Server_Optimizer` instance.
+
+        Parameters
+        ----------
+        method: String
+            Either 'sgd', 'momentum' (FedAvgM), 'adam' (FedAdam) or 'yogi' (FedYogi)
+
+        learning_rate: float
+            Learning rate of the server. With 'sgd' and learning rate 1 the global model is replaced by the aggregated one
+
+        momentum: float
+            Decay of the first moment (momentum) of the pseudo-gradients
+
+        beta2: float
+            Decay of the second moment of the pseudo-gradients, only used by 'adam' and 'yogi'
+
+        epsilon: float
+            Adaptivity: added to the square root of the second moment, which also starts at its square
+        """
+        self.method = method.lower()
+        if self.method not in ['sgd', 'momentum', 'adam', 'yogi']:
+            raise ValueError('Unknown server optimizer: %s' %method)
+        self.learning_rate = learning_rate
+        self.momentum = momentum
+        self.beta2 = beta2
+        self.epsilon = epsilon
+
+        self.shapes = None          # Shapes of the layers
+        self.offsets = None         # Position of every layer in the flat arrays
+        self.first_moment = None    # Momentum of the pseudo-gradients
+        self.second_moment = None   # Second moment of the pseudo-gradients
+        self.scratch = None         # Work array, so that the steps do not allocate temporaries
+        self.num_steps = 0          # Number of steps applied
+
+
+
+    def allocate(self, weights):
+        """
+        Allocate the state of the optimizer for a model.
+
+        Parameters
+        ----------
+        weights: List of numpy arrays
+            Model, one array per layer
+        """
+        self.shapes = [np.shape(layer) for layer in weights]
+        self.offsets = np.cumsum([0] + [int(np.prod(shape)) for shape in self.shapes])
+        num_params = int(self.offsets[-1])
+        self.first_moment = np.zeros(num_params, dtype=np.float32) if self.method != 'sgd' else None
+        self.second_moment = np.full(num_params, self.epsilon**2, dtype=np.float32) if self.method in ['adam', 'yogi'] else None
+        self.scratch = np.empty(num_params, dtype=np.float32)
+        self.num_steps = 0
+
+
+
+    def get_state(self):
+        """
+        State of the optimizer, to be stored in a checkpoint. The arrays are copies, so that they can be written while
+        the next steps are applied.
+
+        Returns
+        ----------
+        state: Dictionary
+            Numpy arrays and JSON serializable values
+        """
+        return {'method': self.method,
+                'shapes': [list(shape) for shape in self.shapes] if self.shapes is not None else None,
+                'first_moment': self.first_moment.copy() if self.first_moment is not None else None, # Updated in place by the next step
+                'second_moment': self.second_moment.copy() if self.second_moment is not None else None,
+                'num_steps': self.num_steps}
+
+
+
+    def set_state(self, state):
+        """
+        Restore the state returned by `get_state`.
+
+        Parameters
+        ----------
+        state: Dictionary
+            State stored in a checkpoint
+        """
+        if state.get('method') != self.method:
+            raise ValueError('The checkpoint holds the state of a %s server optimizer, not %s' %(state.get('method'), self.method))
+        if state.get('shapes') is None:
+            return
+        self.allocate([np.empty(shape) for shape in state['shapes']]) # Only the shapes are used
+        if self.first_moment is not None:
+            self.first_moment[:] = state['first_moment']
+        if self.second_moment is not None:
+            self.second_moment[:] = state['second_moment']
+        self.num_steps = state['num_steps']
+
+
+
+    def step(self, weights, gradients):
+        """
+        Apply a step of the optimizer.
+
+        Parameters
+        ----------
+        weights: List of numpy arrays
+            Current global model, one array per layer
+
+        gradients: List of numpy arrays
+            Pseudo-gradients, for instance the global model minus the aggregated model, one array per layer
+
+        Returns
+        ----------
+        new_weights: List of numpy arrays
+            Updated global model
+        """
+        if self.shapes is None or [np.shape(layer) for layer in weights] != self.shapes:
+            self.allocate(weights)
+        new_weights = []
+        for index_layer, (layer, gradient) in enumerate(zip(weights, gradients)):
+            start, stop = self.offsets[index_layer], self.offsets[index_layer+1]
+            gradient = np.ravel(gradient)
+            direction = self.scratch[start:stop]
+            if self.method == 'sgd':
+                direction[:] = gradient
+            else:
+                first_moment = self.first_moment[start:stop]
+                if self.method == 'momentum':
+                    first_moment *= self.momentum
+                    first_moment += gradient
+                else:
+                    first_moment *= self.momentum
+                    first_moment += (1. - self.momentum)*gradient
+                direction[:] = first_moment
+                if self.method in ['adam', 'yogi']:
+                    second_moment = self.second_moment[start:stop]
+                    squared = np.square(gradient)
+                    if self.method == 'adam':
+                        second_moment *= self.beta2
+                        second_moment += (1. - self.beta2)*squared
+                    else: # Additive update, the second moment changes slowly when gradients are sparse or noisy
+                        second_moment -= (1. - self.beta2)*squared*np.sign(second_moment - squared)
+                    np.sqrt(second_moment, out=squared)
+                    squared += self.epsilon
+                    direction /= squared
+            new_layer = np.array(layer, dtype=np.result_type(layer, np.float32))
+            new_layer.reshape(-1)[:] -= self.learning_rate*direction
+            new_weights.append(new_layer)
+        self.num_steps += 1
+        return new_weights
@@ -127,6 +127,28 @@ class MasterNode(Common_to_all_objects):
         
         #self.normalize_data = False
         self.robust = None                          
+        self.async_mode = False
+        self.buffer_size = None
+        self.staleness_exponent = 0.5
+        self.round_deadline = None
+        self.min_quorum = 1
+        self.sampling_fraction = 1.
+        self.delta_broadcast = False
+        self.compression = None
+        self.sparsity = None
+        self.sparsification = 'topk'
+        self.server_optimizer = None
+        self.server_learning_rate = None
+        self.server_momentum = 0.9
+        self.server_beta2 = 0.99
+        self.patience = None
+        self.min_delta = 0.
+        self.convergence_tolerance = None
+        self.eval_every = 1
+        self.val_subsample = None
+        self.eval_async = False
+        self.checkpoint_dir = None
+        self.checkpoint_every = 1
         self.classes = None                           
         self.balance_classes = False
         # Processing kwargs
@@ -202,7 +224,7 @@ class MasterNode(Common_to_all_objects):
 
             elif model_type == 'NN':
                 from RobustMMLL.models.POM1.NeuralNetworks.neural_network import NN_Master
-                self.MasterMLmodel = NN_Master(self.comms, self.logger, self.verbose, self.robust, model_architecture=self.model_architecture, Nmaxiter=self.Nmaxiter, learning_rate=self.learning_rate, model_averaging=self.model_averaging, optimizer=self.optimizer, loss=self.loss, metric=self.metric, batch_size=self.batch_size, num_epochs=self.num_epochs)
+                self.MasterMLmodel = NN_Master(self.comms, self.logger, self.verbose, self.robust, model_architecture=self.model_architecture, Nmaxiter=self.Nmaxiter, learning_rate=self.learning_rate, model_averaging=self.model_averaging, optimizer=self.optimizer, loss=self.loss, metric=self.metric, batch_size=self.batch_size, num_epochs=self.num_epochs, async_mode=self.async_mode, buffer_size=self.buffer_size, staleness_exponent=self.staleness_exponent, round_deadline=self.round_deadline, min_quorum=self.min_quorum, sampling_fraction=self.sampling_fraction, delta_broadcast=self.delta_broadcast, compression=self.compression, sparsity=self.sparsity, sparsification=self.sparsification, server_optimizer=self.server_optimizer, server_learning_rate=self.server_learning_rate, server_momentum=self.server_momentum, server_beta2=self.server_beta2, patience=self.patience, min_delta=self.min_delta, convergence_tolerance=self.convergence_tolerance, eval_every=self.eval_every, val_subsample=self.val_subsample, eval_async=self.eval_async, checkpoint_dir=self.checkpoint_dir, checkpoint_every=self.checkpoint_every)
                 self.display('MasterNode: Created %s model, POM = %d' % (model_type, self.pom))
 
             elif model_type == 'SVM':
@@ -320,10 +342,21 @@ class MasterNode(Common_to_all_objects):
             self.MasterMLmodel.yval = self.yval
             '''
 
-    def fit(self, Xval=None, yval=None):
+    def fit(self, Xval=None, yval=None, resume=False):
         """
         Train the Machine Learning Model
 
+        Parameters
+        ----------
+        Xval: ndarray
+            Validation patterns
+
+        yval: ndarray
+            Validation targets
+
+        resume: Boolean or String
+            If True, the training continues from the checkpoint in checkpoint_dir. A path to a checkpoint (or to its
+            directory) can also be given
         """
         if Xval is not None:
             self.MasterMLmodel.Xval = np.array(Xval)
@@ -403,6 +436,11 @@ class MasterNode(Common_to_all_objects):
                 pass
 
         ###################  Common to all POMS  ##################
+        if resume:
+            if not hasattr(self.MasterMLmodel, 'load_checkpoint'):
+                raise ValueError('MasterNode: Resuming the training is not available for this model')
+            self.MasterMLmodel.load_checkpoint(resume if isinstance(resume, str) else None)
+
         try:
             self.MasterMLmodel.train_Master()
             # Set this to True if the model has been sucessfully trained.
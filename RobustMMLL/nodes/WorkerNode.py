@@ -45,6 +45,7 @@ class WorkerNode(Common_to_all_objects):
         self.logger = logger            # logger
         self.verbose = verbose          # print on screen when true
         self.master_address = 'ma'
+        self.robust = None              # Robust_Worker instance, if any
         
         self.process_kwargs(kwargs)
 
@@ -209,7 +210,7 @@ class WorkerNode(Common_to_all_objects):
 
             elif model_type == 'NN':
                 from RobustMMLL.models.POM1.NeuralNetworks.neural_network import NN_Worker
-                self.workerMLmodel = NN_Worker(self.master_address, self.comms, self.logger,  self.verbose, self.Xtr_b, self.ytr)
+                self.workerMLmodel = NN_Worker(self.master_address, self.comms, self.logger,  self.verbose, self.Xtr_b, self.ytr, self.robust)
 
             elif model_type == 'SVM':
                 from RobustMMLL.models.POM1.SVM.SVM import SVM_Worker
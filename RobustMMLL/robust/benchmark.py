@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+'''
+Benchmark of the robust aggregation methods of Robust_Master on synthetic byzantine workloads.
+
+Usage (runs offline on CPU, only NumPy is needed):
+    python -m RobustMMLL.robust.benchmark --model mlp --workers 10 100 1000 --attacks sign_flip gaussian little_is_enough
+'''
+
+__author__ = "Marcos Fernández Díaz"
+__date__ = "September 2020"
+
+
+import argparse
+import csv
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+from RobustMMLL.robust.robust import Robust_Master, inverse_normal_cdf
+
+
+# Layer shapes of some Keras models, as returned by keras_model.get_weights()
+MODEL_SHAPES = {
+    'logistic': [(784, 10), (10,)],
+    'mlp': [(784, 128), (128,), (128, 10), (10,)],
+    'cnn': [(3, 3, 1, 32), (32,), (3, 3, 32, 64), (64,), (1600, 128), (128,), (128, 10), (10,)],
+}
+
+METHODS = ['average', 'weighted_average', 'median', 'trimmed_mean', 'winsorized_mean', 'krum', 'multikrum', 'bulyan', 'geometric_median',
+           'clipped_mean', 'centered_clipping', 'approx_median', 'foolsgold'] # approx_quantile at the default quantile is approx_median
+
+ATTACKS = ['none', 'sign_flip', 'gaussian', 'little_is_enough']
+
+
+
+def model_shapes(keras_model):
+    """
+    Layer shapes of a Keras model, to benchmark the aggregation methods with the same layout.
+
+    Parameters
+    ----------
+    keras_model: Keras model
+        Model whose weights are aggregated
+
+    Returns
+    ----------
+    shapes: List of tuples
+        Shape of every array returned by get_weights()
+    """
+    return [np.shape(layer) for layer in keras_model.get_weights()]
+
+
+
+def split_layers(flat_weights, shapes):
+    """
+    Split a flattened model into a list of layers (views of the flattened array).
+
+    Parameters
+    ----------
+    flat_weights: 1-D numpy array
+        Flattened model
+
+    shapes: List of tuples
+        Shape of every layer
+
+    Returns
+    ----------
+    weights: List of numpy arrays
+        Model represented as a list of numpy arrays (one per layer)
+    """
+    offsets = np.cumsum([0] + [int(np.prod(shape)) for shape in shapes])
+    return [flat_weights[offsets[index_layer]:offsets[index_layer+1]].reshape(shape) for index_layer, shape in enumerate(shapes)]
+
+
+
+def generate_workload(shapes, num_honest, noise_scale=0.01, seed=0):
+    """
+    Generate the updates of the honest workers. Every honest update is the reference model plus a step
+    shared by all the workers plus independent gaussian noise.
+
+    Parameters
+    ----------
+    shapes: List of tuples
+        Shape of every layer
+
+    num_honest: Int
+        Number of honest workers
+
+    noise_scale: float
+        Standard deviation of the shared step and of the noise of every worker
+
+    seed: Int
+        Seed of the random generator
+
+    Returns
+    ----------
+    reference: 1-D numpy array
+        Flattened reference model
+
+    honest: 2-D numpy array
+        Honest updates, one per row
+    """
+    num_params = int(sum(np.prod(shape) for shape in shapes))
+    random_state = np.random.RandomState(seed)
+    reference = (0.05*random_state.standard_normal(num_params)).astype(np.float32)
+    step = noise_scale*random_state.standard_normal(num_params)
+    honest = np.empty((num_honest, num_params), dtype=np.float32)
+    for index_worker in range(num_honest):
+        honest[index_worker] = reference + step + noise_scale*random_state.standard_normal(num_params)
+    return reference, honest
+
+
+
+def byzantine_updates(attack, reference, honest, num_byzantine, attack_scale=10., seed=0):
+    """
+    Generate the updates sent by the byzantine workers, which know the updates of the honest workers.
+
+    Parameters
+    ----------
+    attack: String
+        'none' (byzantine workers behave honestly), 'sign_flip' (step of the honest mean reversed and scaled by attack_scale),
+        'gaussian' (honest mean plus gaussian noise attack_scale times larger than the honest spread) or 'little_is_enough'
+        (honest mean shifted by the largest number of standard deviations that stays undetected, Baruch et al. 2019)
+
+    reference: 1-D numpy array
+        Flattened reference model
+
+    honest: 2-D numpy array
+        Honest updates, one per row
+
+    num_byzantine: Int
+        Number of byzantine workers
+
+    attack_scale: float
+        Strength of the 'sign_flip' and 'gaussian' attacks
+
+    seed: Int
+        Seed of the random generator
+
+    Returns
+    ----------
+    byzantine: 2-D numpy array
+        Byzantine updates, one per row
+    """
+    random_state = np.random.RandomState(seed + 1)
+    num_honest, num_params = honest.shape
+    byzantine = np.empty((num_byzantine, num_params), dtype=honest.dtype)
+    if num_byzantine == 0:
+        return byzantine
+    mean = np.mean(honest, axis=0, dtype=np.float64)
+    std = np.std(honest, axis=0, dtype=np.float64)
+
+    if attack == 'none':
+        byzantine[:] = honest[random_state.randint(num_honest, size=num_byzantine)]
+    elif attack == 'sign_flip':
+        byzantine[:] = reference - attack_scale*(mean - reference)
+    elif attack == 'gaussian':
+        for index_worker in range(num_byzantine):
+            byzantine[index_worker] = mean + attack_scale*std*random_state.standard_normal(num_params)
+    elif attack == 'little_is_enough':
+        num_workers = num_honest + num_byzantine
+        num_supporters = num_workers // 2 + 1 - num_byzantine # Honest workers that must look farther than the attackers
+        z = inverse_normal_cdf(float(num_workers - num_supporters) / num_workers)
+        byzantine[:] = mean - z*std
+    else:
+        raise ValueError('Unknown attack: %s' %attack)
+    return byzantine
+
+
+
+def run_aggregation(method, shapes, reference, updates, num_byzantine, options):
+    """
+    Add the updates to a new Robust_Master instance one by one, as NN_Master does, and aggregate them.
+
+    Parameters
+    ----------
+    method: String
+        Aggregation method
+
+    shapes: List of tuples
+        Shape of every layer
+
+    reference: 1-D numpy array
+        Flattened reference model
+
+    updates: List of 1-D numpy arrays
+        Flattened update of every worker
+
+    num_byzantine: Int
+        Number of byzantine workers
+
+    options: Dictionary
+        Additional arguments of Robust_Master
+
+    Returns
+    ----------
+    flat_weights: 1-D numpy array
+        Flattened aggregated model
+
+    elapsed: float
+        Seconds spent adding and aggregating the updates
+    """
+    robust = Robust_Master(method=method, num_byzantine=num_byzantine, **options)
+    start = time.perf_counter()
+    robust.set_reference(split_layers(reference, shapes))
+    robust.allocate(len(updates))
+    for index_worker, update in enumerate(updates):
+        robust.add_update(split_layers(update, shapes), 1., index_worker)
+    new_weights = robust.aggregate()
+    elapsed = time.perf_counter() - start
+    robust.close()
+    return np.concatenate([np.ravel(layer) for layer in new_weights]), elapsed
+
+
+
+def benchmark(shapes, num_workers_list=(10, 100, 1000), attacks=('sign_flip', 'gaussian', 'little_is_enough'), methods=METHODS,
+              byzantine_fraction=0.2, noise_scale=0.01, attack_scale=10., measure_memory=True, seed=0, options=None, display=print):
+    """
+    Measure wall time, peak memory and distance to the honest mean of every aggregation method.
+
+    Parameters
+    ----------
+    shapes: List of tuples
+        Shape of every layer of the model
+
+    num_workers_list: List of Ints
+        Numbers of workers to benchmark
+
+    attacks: List of Strings
+        Attacks of the byzantine workers (see `byzantine_updates`)
+
+    methods: List of Strings
+        Aggregation methods of Robust_Master
+
+    byzantine_fraction: float
+        Fraction of byzantine workers
+
+    noise_scale: float
+        Spread of the honest updates
+
+    attack_scale: float
+        Strength of the 'sign_flip' and 'gaussian' attacks
+
+    measure_memory: Boolean
+        If True, every aggregation is run a second time under tracemalloc to measure its peak memory (the first run
+        is not traced, so that the tracing overhead does not affect the wall time)
+
+    seed: Int
+        Seed of the random generator
+
+    options: Dictionary
+        Additional arguments of Robust_Master (for instance streaming, spool_dir, num_jobs or backend)
+
+    display: Function
+        Function called with every result line
+
+    Returns
+    ----------
+    results: List of dictionaries
+        One result per combination of number of workers, attack and method
+    """
+    options = options if options is not None else {}
+    results = []
+    display('%8s %8s %18s %18s %10s %10s %12s %10s' %('workers', 'byzant.', 'attack', 'method', 'time (s)', 'peak (MB)', 'distance', 'relative'))
+    for num_workers in num_workers_list:
+        num_byzantine = int(byzantine_fraction*num_workers)
+        reference, honest = generate_workload(shapes, num_workers - num_byzantine, noise_scale, seed)
+        honest_mean = np.mean(honest, axis=0, dtype=np.float64)
+        honest_step = np.linalg.norm(honest_mean - reference)
+
+        for attack in attacks:
+            byzantine = byzantine_updates(attack, reference, honest, num_byzantine, attack_scale, seed)
+            updates = list(byzantine) + list(honest) # Rows of the workload, the byzantine workers arrive first
+
+            for method in methods:
+                result = {'num_params': honest.shape[1], 'num_workers': num_workers, 'num_byzantine': num_byzantine, 'attack': attack, 'method': method}
+                try:
+                    flat_weights, elapsed = run_aggregation(method, shapes, reference, updates, num_byzantine, options)
+                    peak = np.nan
+                    if measure_memory:
+                        tracemalloc.start()
+                        run_aggregation(method, shapes, reference, updates, num_byzantine, options)
+                        peak = tracemalloc.get_traced_memory()[1] / 2.**20
+                        tracemalloc.stop()
+                except ValueError as error: # Configuration not supported by the method (e.g. too few workers for Bulyan)
+                    if tracemalloc.is_tracing():
+                        tracemalloc.stop()
+                    display('%8d %8d %18s %18s   skipped: %s' %(num_workers, num_byzantine, attack, method, error))
+                    result['error'] = str(error)
+                    results.append(result)
+                    continue
+
+                distance = np.linalg.norm(flat_weights - honest_mean)
+                result.update({'time': elapsed, 'peak_memory': peak, 'distance': distance, 'relative_distance': distance / honest_step})
+                display('%8d %8d %18s %18s %10.4f %10.1f %12.4g %10.4f' %(num_workers, num_byzantine, attack, method, elapsed, peak, distance, distance / honest_step))
+                results.append(result)
+    return results
+
+
+
+def main(argv=None):
+    """
+    Command line interface of the benchmark.
+
+    Parameters
+    ----------
+    argv: List of Strings
+        Command line arguments. If None, sys.argv is used
+    """
+    parser = argparse.ArgumentParser(description='Benchmark of the robust aggregation methods on synthetic byzantine workloads')
+    parser.add_argument('--model', default='mlp', choices=sorted(MODEL_SHAPES.keys()), help='Layer shapes of the synthetic model')
+    parser.add_argument('--workers', type=int, nargs='+', default=[10, 100, 1000], help='Numbers of workers')
+    parser.add_argument('--attacks', nargs='+', default=['sign_flip', 'gaussian', 'little_is_enough'], choices=ATTACKS, help='Attacks of the byzantine workers')
+    parser.add_argument('--methods', nargs='+', default=METHODS, choices=METHODS + ['approx_quantile'], help='Aggregation methods')
+    parser.add_argument('--byzantine-fraction', type=float, default=0.2, help='Fraction of byzantine workers')
+    parser.add_argument('--noise-scale', type=float, default=0.01, help='Spread of the honest updates')
+    parser.add_argument('--attack-scale', type=float, default=10., help='Strength of the sign flip and gaussian attacks')
+    parser.add_argument('--no-memory', action='store_true', help='Do not measure the peak memory (halves the running time)')
+    parser.add_argument('--streaming', action='store_true', help='Fold the updates into an accumulator when the method allows it')
+    parser.add_argument('--spool-dir', default=None, help='Spool the updates to a memory-mapped file in this directory')
+    parser.add_argument('--num-jobs', type=int, default=1, help='Number of threads or processes aggregating blocks in parallel')
+    parser.add_argument('--backend', default='thread', choices=['thread', 'process'], help='Parallel backend')
+    parser.add_argument('--quantile', type=float, default=0.25, help='Quantile estimated by approx_quantile')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random generator')
+    parser.add_argument('--csv', default=None, help='Write the results to this CSV file')
+    args = parser.parse_args(argv)
+
+    options = {'streaming': args.streaming, 'spool_dir': args.spool_dir, 'num_jobs': args.num_jobs, 'backend': args.backend, 'quantile': args.quantile}
+    results = benchmark(MODEL_SHAPES[args.model], args.workers, args.attacks, args.methods, args.byzantine_fraction, args.noise_scale,
+                        args.attack_scale, not args.no_memory, args.seed, options)
+
+    if args.csv is not None:
+        fields = ['num_params', 'num_workers', 'num_byzantine', 'attack', 'method', 'time', 'peak_memory', 'distance', 'relative_distance', 'error']
+        with open(args.csv, 'w', newline='') as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(results)
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
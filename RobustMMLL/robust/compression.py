@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+'''
+Compression of the updates sent by the workers to the master
+'''
+
+__author__ = "Marcos Fernández Díaz"
+__date__ = "September 2020"
+
+
+import numpy as np
+
+
+
+def is_encoded(layer):
+    """
+    Check if a layer has been encoded by `Update_Compressor`.
+
+    Parameters
+    ----------
+    layer: numpy array or Dictionary
+        Layer of an update
+
+    Returns
+    ----------
+    encoded: Boolean
+        True if the layer is encoded
+    """
+    return isinstance(layer, dict) and 'encoding' in layer
+
+
+
+def layer_shape(layer):
+    """
+    Shape of a layer of an update, either encoded or not.
+
+    Parameters
+    ----------
+    layer: numpy array or Dictionary
+        Layer of an update
+
+    Returns
+    ----------
+    shape: Tuple
+        Shape of the decoded layer
+    """
+    return tuple(layer['shape']) if is_encoded(layer) else np.shape(layer)
+
+
+
+def decode_layer(layer, out, weight=1.):
+    """
+    Decode a layer of an update, adding it to a flat array (for instance, a row of the aggregation buffer already
+    containing the base model), so that no dense copy of the layer is created. Sparse layers are scattered into
+    the array.
+
+    Parameters
+    ----------
+    layer: numpy array or Dictionary
+        Layer of an update, either encoded or not
+
+    out: 1-D numpy array
+        Array the decoded layer is added to
+
+    weight: float
+        Factor multiplying the decoded layer
+    """
+    if not is_encoded(layer):
+        out += weight*np.ravel(layer) if weight != 1. else np.ravel(layer)
+    elif layer['encoding'] == 'sparse':
+        values = layer['values']
+        if is_encoded(values): # Values compressed in turn
+            dense_values = np.zeros(len(layer['indices']), dtype=out.dtype)
+            decode_layer(values, dense_values)
+            values = dense_values
+        out[layer['indices']] += weight*values if weight != 1. else values # The indices are unique
+    elif layer['encoding'] == 'float16':
+        out += weight*np.ravel(layer['values']) if weight != 1. else np.ravel(layer['values'])
+    elif layer['encoding'] == 'int8':
+        values = np.ravel(layer['values']).astype(out.dtype)
+        values -= layer['zero_point']
+        values *= layer['scale']*weight
+        out += values
+    else:
+        raise ValueError('Unknown encoding: %s' %layer['encoding'])
+
+
+
+def decode_update(weights, base=None):
+    """
+    Decode all the layers of an update into new arrays.
+
+    Parameters
+    ----------
+    weights: List of numpy arrays or Dictionaries
+        Update, with every layer either encoded or not
+
+    base: List of numpy arrays
+        If not None, the update is the difference with this model, which is added to it
+
+    Returns
+    ----------
+    new_weights: List of numpy arrays
+        Decoded model
+    """
+    new_weights = []
+    for index_layer, layer in enumerate(weights):
+        if base is None and not is_encoded(layer):
+            new_weights.append(layer)
+            continue
+        if base is not None:
+            new_layer = np.array(base[index_layer], dtype=np.result_type(base[index_layer], np.float32))
+        else:
+            new_layer = np.zeros(layer_shape(layer), dtype=layer['dtype'])
+        decode_layer(layer, new_layer.reshape(-1))
+        new_weights.append(new_layer)
+    return new_weights
+
+
+
+
+class Update_Compressor:
+    """
+    This class compresses the updates sent by a worker to the master, runs at Worker node. Every layer is either
+    cast to float16 or quantized to int8 with stochastic rounding, so that the quantization error has zero mean.
+    Optionally, only a fraction of the values of every layer is sent (top-k or random-k sparsification), and the
+    values not sent are kept in a residual that is added to the update of the next round (error feedback).
+    """
+    def __init__(self, compression=None, sparsity=None, sparsification='topk'):
+        """
+        Create a class `Update_Compressor` instance.
+
+        Parameters
+        ----------
+        compression: String
+            Either 'float16' (half precision, 2x smaller), 'int8' (8 bits with a scale and zero point per layer, 4x smaller)
+            or None (no compression)
+
+        sparsity: float
+            Fraction of the values of every layer sent to the master, None to send all of them
+
+        sparsification: String
+            Values sent when sparsity is set: 'topk' (largest magnitude) or 'randomk' (sampled uniformly)
+        """
+        self.compression = compression.lower() if compression is not None else None
+        if self.compression not in [None, 'float16', 'int8']:
+            raise ValueError('Unknown compression: %s' %compression)
+        if sparsity is not None and not 0. < sparsity <= 1.:
+            raise ValueError('sparsity must be in (0, 1], got %s' %sparsity)
+        self.sparsity = sparsity
+        self.sparsification = sparsification.lower()
+        if self.sparsification not in ['topk', 'randomk']:
+            raise ValueError('Unknown sparsification: %s' %sparsification)
+        self.residuals = None # Values not sent yet, one flat array per layer
+
+
+
+    def quantize(self, layer):
+        """
+        Quantize a layer to int8 with stochastic rounding. The range [min, max] of the layer is mapped to [-128, 127].
+        Constant layers are encoded exactly.
+
+        Parameters
+        ----------
+        layer: numpy array
+            Layer to quantize
+
+        Returns
+        ----------
+        encoded: Dictionary
+            Quantized values, scale and zero point of the layer
+        """
+        low = float(np.min(layer)) if layer.size > 0 else 0.
+        high = float(np.max(layer)) if layer.size > 0 else 0.
+        if high == low: # Constant layer (for instance a single value), sent exactly as +-127 steps of |value|/127
+            scale = abs(low) / 127. if low != 0 else 1.
+            values = np.full(layer.shape, np.sign(low)*127, dtype=np.int8)
+            return {'encoding': 'int8', 'values': values, 'scale': scale, 'zero_point': 0, 'shape': layer.shape, 'dtype': layer.dtype.str}
+        scale = (high - low) / 255.
+        zero_point = int(np.round(-128. - low / scale))
+        values = layer / scale
+        values += zero_point
+        values += np.random.uniform(0., 1., layer.shape) # Stochastic rounding, unbiased
+        np.floor(values, out=values)
+        np.clip(values, -128, 127, out=values)
+        return {'encoding': 'int8', 'values': values.astype(np.int8), 'scale': scale, 'zero_point': zero_point,
+                'shape': layer.shape, 'dtype': layer.dtype.str}
+
+
+
+    def encode_dense(self, layer):
+        """
+        Compress a layer without sparsification.
+
+        Parameters
+        ----------
+        layer: numpy array
+            Layer to compress
+
+        Returns
+        ----------
+        encoded: numpy array or Dictionary
+            Compressed layer
+        """
+        if self.compression is None:
+            return layer
+        if self.compression == 'float16':
+            return {'encoding': 'float16', 'values': layer.astype(np.float16), 'shape': layer.shape, 'dtype': layer.dtype.str}
+        return self.quantize(layer)
+
+
+
+    def sparsify(self, index_layer, layer):
+        """
+        Select the values of a layer sent to the master after adding the residual of the previous rounds, and keep
+        the rest (and the compression error of the values sent) in the residual.
+
+        Parameters
+        ----------
+        index_layer: Int
+            Position of the layer in the update
+
+        layer: numpy array
+            Layer to sparsify
+
+        Returns
+        ----------
+        encoded: numpy array or Dictionary
+            Sparse layer, or the dense layer if sending indices would not save space
+        """
+        residual = self.residuals[index_layer]
+        residual += np.ravel(layer) # Error feedback: the residual now holds everything not sent yet
+        num_values = residual.size
+        num_selected = int(np.ceil(self.sparsity*num_values))
+        if 2*num_selected >= num_values: # Indices and values take more space than the dense layer
+            encoded = self.encode_dense(residual.reshape(layer.shape).astype(layer.dtype))
+            sent = np.zeros(num_values, dtype=residual.dtype)
+            decode_layer(encoded, sent)
+            residual -= sent
+            return encoded
+
+        if self.sparsification == 'topk':
+            indices = np.argpartition(np.abs(residual), num_values-num_selected)[num_values-num_selected:] # Linear time selection
+        else:
+            indices = np.random.choice(num_values, num_selected, replace=False)
+        indices = np.sort(indices).astype(np.int32 if num_values < 2**31 else np.int64)
+        values = self.encode_dense(residual[indices].astype(layer.dtype))
+        sent = np.zeros(num_selected, dtype=residual.dtype)
+        decode_layer(values, sent)
+        residual[indices] -= sent # Only the compression error of the values sent remains
+        return {'encoding': 'sparse', 'indices': indices, 'values': values, 'shape': layer.shape, 'dtype': layer.dtype.str}
+
+
+
+    def encode(self, weights):
+        """
+        Compress all the layers of an update.
+
+        Parameters
+        ----------
+        weights: List of numpy arrays
+            Update (model, difference with the model received or gradients), one array per layer
+
+        Returns
+        ----------
+        encoded_weights: List of numpy arrays or Dictionaries
+            Compressed update
+        """
+        weights = [np.asarray(layer) for layer in weights]
+        if self.sparsity is None:
+            return weights if self.compression is None else [self.encode_dense(layer) for layer in weights]
+        if self.residuals is None or [residual.size for residual in self.residuals] != [layer.size for layer in weights]:
+            self.residuals = [np.zeros(layer.size, dtype=np.float64 if layer.dtype == np.float64 else np.float32) for layer in weights]
+        return [self.sparsify(index_layer, layer) for index_layer, layer in enumerate(weights)]
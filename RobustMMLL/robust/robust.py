@@ -7,27 +7,1419 @@ __author__ = "Marcos Fernández Díaz"
 __date__ = "September 2020"
 
 
+import math
+import os
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import numpy as np
 
+from RobustMMLL.robust.compression import is_encoded, layer_shape, decode_layer, decode_update
+
+
+SHARED_MEMORY_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None # Files shared with the process pool live in RAM when possible
+
+
+
+def trimmed_mean(updates, k):
+    """
+    Coordinate-wise trimmed mean. The k smallest and k largest values of every coordinate are found with
+    a partial selection along the worker axis (np.partition) instead of a full sort.
+
+    Parameters
+    ----------
+    updates: 2-D numpy array
+        Updates of the workers, one per row. It is partitioned in place.
+
+    k: Int
+        Number of values discarded at each side of every coordinate
+
+    Returns
+    ----------
+    flat_weights: 1-D numpy array
+        Trimmed mean of every coordinate
+    """
+    num_workers = updates.shape[0]
+    k = min(k, (num_workers-1)//2)
+    if k == 0:
+        return np.mean(updates, axis=0)
+    updates.partition((k, num_workers-k-1), axis=0) # Values between both pivots are the ones kept
+    return np.mean(updates[k:num_workers-k], axis=0)
+
+
+
+def winsorized_mean(updates, k):
+    """
+    Coordinate-wise winsorized mean. The k smallest and k largest values of every coordinate are replaced
+    by the k-th smallest and k-th largest values, found with a partial selection along the worker axis.
+
+    Parameters
+    ----------
+    updates: 2-D numpy array
+        Updates of the workers, one per row. It is partitioned in place.
+
+    k: Int
+        Number of values clipped at each side of every coordinate
+
+    Returns
+    ----------
+    flat_weights: 1-D numpy array
+        Winsorized mean of every coordinate
+    """
+    num_workers = updates.shape[0]
+    k = min(k, (num_workers-1)//2)
+    if k == 0:
+        return np.mean(updates, axis=0)
+    updates.partition((k, num_workers-k-1), axis=0)
+    flat_weights = np.sum(updates[k:num_workers-k], axis=0)
+    flat_weights += k*(updates[k] + updates[num_workers-k-1]) # Clipped values at both sides
+    flat_weights /= num_workers
+    return flat_weights
+
+
+
+def order_statistic(updates, method, k=0):
+    """
+    Coordinate-wise aggregation based on order statistics, modifying the updates in place.
+
+    Parameters
+    ----------
+    updates: 2-D numpy array
+        Updates of the workers, one per row
+
+    method: String
+        Either 'median', 'trimmed_mean' or 'winsorized_mean'
+
+    k: Int
+        Number of values trimmed or clipped at each side of every coordinate
+
+    Returns
+    ----------
+    flat_weights: 1-D numpy array
+        Aggregate of every coordinate
+    """
+    if method == 'median':
+        return np.median(updates, axis=0, overwrite_input=True)
+    if method == 'trimmed_mean':
+        return trimmed_mean(updates, k)
+    return winsorized_mean(updates, k)
+
+
+
+def reduce_shared_block(path, dtype, offset, shape, rows, start, stop, method, k):
+    """
+    Compute an order statistic over a block of coordinates of the updates stored in a shared file. Runs in the
+    processes of the pool, which open the file by name instead of receiving a copy of the updates.
+
+    Parameters
+    ----------
+    path: String
+        Name of the file containing the updates
+
+    dtype: String
+        Data type of the updates
+
+    offset: Int
+        Offset in bytes of the region of the file of shape `shape`
+
+    shape: Tuple
+        Shape (n_workers, n_coordinates) of the region of the file containing the block
+
+    rows: Int or 1-D numpy array
+        Number of updates of the round, or indexes of the updates to aggregate
+
+    start, stop: Int
+        First and last (excluded) columns of the block inside the region
+
+    method: String
+        Either 'median', 'trimmed_mean' or 'winsorized_mean'
+
+    k: Int
+        Number of values trimmed or clipped at each side of every coordinate
+
+    Returns
+    ----------
+    flat_weights: 1-D numpy array
+        Aggregate of every coordinate of the block
+    """
+    region = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape)
+    block = np.array(region[:rows, start:stop]) if np.isscalar(rows) else region[rows, start:stop]
+    return order_statistic(block, method, k)
+
+
+
+def inverse_normal_cdf(probability):
+    """
+    Quantile function of the standard normal distribution, computed by bisection.
+
+    Parameters
+    ----------
+    probability: float
+        Probability between 0 and 1
+
+    Returns
+    ----------
+    z: float
+        Value whose cumulative probability is the given one
+    """
+    low, high = -10., 10.
+    for _ in range(100):
+        middle = (low + high) / 2.
+        if 0.5*(1. + math.erf(middle/math.sqrt(2.))) < probability:
+            low = middle
+        else:
+            high = middle
+    return (low + high) / 2.
+
+
+
+def chi2_quantile(probability, dof):
+    """
+    Quantile function of the chi-square distribution, using the Wilson-Hilferty approximation.
+
+    Parameters
+    ----------
+    probability: float
+        Probability between 0 and 1
+
+    dof: Int
+        Degrees of freedom
+
+    Returns
+    ----------
+    x: float
+        Value whose cumulative probability is the given one
+    """
+    factor = 2. / (9.*dof)
+    return dof*max(0., 1. - factor + inverse_normal_cdf(probability)*math.sqrt(factor))**3
+
 
 
 class Robust_Master:
     """
     This class implements robust aggregation methods for different algorithms, runs at Master node.
+
+    The updates received from the workers are packed into a single preallocated buffer of shape
+    (n_workers, n_params), which is reused across rounds. Every aggregation method is computed as a
+    vectorized reduction over the worker axis of that buffer and the result is split back into layers.
+    In streaming mode, the methods that can be computed incrementally fold every update into an
+    accumulator of the size of the model as soon as it arrives, so the updates are never stored.
+    For very large models, the updates can be spooled to a memory-mapped file instead, and the
+    aggregation then runs over chunks of coordinates that fit in a given memory budget. The approximate
+    median and quantiles only keep a fixed-size histogram per coordinate.
     """
-    def __init__(self, method='average'):
+    def __init__(self, method='average', trim_fraction=0.1, num_byzantine=0, num_selected=None, block_size=65536, tolerance=1e-5, max_iter=100, clip_threshold=None, streaming=False, spool_dir=None, memory_budget=2**28, num_jobs=1, backend='thread', quantile=0.5, sketch_error=0.01, clipping_iters=1, sketch_range=4.):
+        """
+        Create a class `Robust_Master` instance.
+
+        Parameters
+        ----------
+        method: String
+            Name of the aggregation method to use: 'average', 'median', 'trimmed_mean', 'winsorized_mean', 'krum', 'multikrum', 'bulyan', 'geometric_median',
+            'weighted_average' (weighted by the number of samples of every worker), 'clipped_mean', 'centered_clipping', 'approx_median', 'approx_quantile' or 'foolsgold'
+
+        trim_fraction: float
+            Fraction of the workers discarded (trimmed mean) or clipped (winsorized mean) at each side of every coordinate
+
+        num_byzantine: Int
+            Maximum number of byzantine workers tolerated by Krum, Multi-Krum and Bulyan
+
+        num_selected: Int
+            Number of updates averaged by Multi-Krum. If None, n_workers - num_byzantine updates are selected
+
+        block_size: Int
+            Number of coordinates processed at once when computing distances in float64, and in every parallel task
+
+        tolerance: float
+            Relative change of the estimate below which the Weiszfeld iterations of the geometric median stop
+
+        max_iter: Int
+            Maximum number of Weiszfeld iterations of the geometric median
+
+        clip_threshold: float
+            Maximum norm of the difference between an update and the reference model in the clipped mean (or the center
+            in centered clipping). If None, the median of the norms of the round is used (not available in streaming mode)
+
+        streaming: Boolean
+            If True, 'average', 'weighted_average' and 'clipped_mean' (with a fixed clip_threshold) fold every update
+            into an accumulator when it is added instead of storing it
+
+        spool_dir: String
+            If not None, the updates are spooled to a memory-mapped file created in this directory instead of being kept in RAM
+
+        memory_budget: Int
+            Approximate number of bytes of RAM used by every chunk of coordinates when aggregating spooled updates
+
+        num_jobs: Int
+            Number of threads (or processes) aggregating blocks of block_size coordinates in parallel
+
+        backend: String
+            Either 'thread' (NumPy reductions release the GIL) or 'process'. With 'process', the median, trimmed mean and
+            winsorized mean run in a process pool reading the updates from a shared file (in /dev/shm when not spooled)
+
+        quantile: float
+            Quantile (between 0 and 1) estimated by 'approx_quantile'
+
+        sketch_error: float
+            Maximum error of 'approx_median' and 'approx_quantile', relative to the range of the histogram of every layer
+            (see sketch_range), when the exact quantile lies inside that range. Every coordinate keeps ceil(1/sketch_error)
+            buckets, with counts of 1 byte up to 255 updates (2 bytes up to 65535). With the default of 100 buckets, the
+            histograms take 100 bytes per parameter, as much as 25 float32 updates (13 in float64), so they only save memory in rounds with more than 25 workers (50 beyond 255 workers).
+            In general, they need less memory than the updates when n_workers > n_buckets*count_bytes/4
+
+        clipping_iters: Int
+            Maximum number of iterations of centered clipping
+
+        sketch_range: float
+            Half width of the histograms of every layer, in multiples of the largest change of the layer in the previous
+            round. In the first round, the range is estimated from the first max(3, 2f + 1) updates
+        """
+        self.method = method.lower() # Convert string to lowercase
+        self.trim_fraction = trim_fraction
+        self.num_byzantine = num_byzantine
+        self.num_selected = num_selected
+        self.block_size = block_size
+        self.tolerance = tolerance
+        self.max_iter = max_iter
+        self.clip_threshold = clip_threshold
+        self.spool_dir = spool_dir
+        self.memory_budget = memory_budget
+        self.num_jobs = num_jobs
+        self.backend = backend.lower()
+        self.thread_pool = None # Pool of threads, created the first time it is needed
+        self.process_pool = None # Pool of processes, created the first time it is needed
+        self.clipping_iters = clipping_iters
+        self.quantile = 0.5 if self.method == 'approx_median' else quantile
+        self.num_buckets = int(np.ceil(1. / sketch_error))
+        self.sketch_range = sketch_range
+        self.needs_sketch = self.method in ['approx_median', 'approx_quantile'] # Methods using the per-coordinate histograms
+        self.streaming = self.needs_sketch or (streaming and (self.method in ['average', 'weighted_average'] or (self.method == 'clipped_mean' and clip_threshold is not None)))
+        self.needs_distances = self.method in ['krum', 'multikrum', 'bulyan'] # Methods using the pairwise distance matrix
+
+        self.shapes = None      # Shapes of the layers of the model
+        self.offsets = None     # Offsets of every layer inside the flattened parameter vector
+        self.num_params = 0     # Total number of parameters of the model
+        self.buffer = None      # Buffer of shape (n_workers, n_params) with the updates of the current round
+        self.spool = None       # Memory-mapped file replacing the buffer, stored worker-major for every layer
+        self.spool_layers = None # Views of shape (n_workers, layer_size) of every layer inside the spool
+        self.spool_file = None  # File backing the spool (or the buffer shared with the process pool)
+        self.capacity = 0       # Number of updates that fit in the buffer (or in the spool)
+        self.num_updates = 0    # Number of updates stored in the buffer in the current round
+        self.update_weights = None # Weight (number of samples) of every update in the buffer
+        self.accumulator = None # Accumulated updates of the current round in streaming mode
+        self.total_weight = 0.  # Accumulated weight of the current round in streaming mode
+        self.reference = None   # Flattened reference model (current global model)
+        self.sketch_counts = None # Histogram of shape (n_params, n_buckets) of every coordinate in the current round
+        self.sketch_center = None # Flattened model at the center of the histograms
+        self.sketch_radius = None # Half width of the range of the histograms of every layer
+        self.sketch_pending = [] # Updates kept until the range of the histograms is known
+        self.sketch_steps = None # Largest change of every layer in the previous round, sets the range of the histograms
+        self.distances = None   # Pairwise squared distances between the updates of the current round
+        self.sq_norms = None    # Squared norms of the updates of the current round
+        self.num_distances = 0  # Number of updates whose distances to all previous updates are already computed
+        self.previous_aggregate = None # Flattened aggregate of the previous round, used as warm start
+        self.num_iterations = 0 # Number of iterations used by the last iterative aggregation
+        self.update_norms = [] # Norm of the difference between every update of the round and the reference model
+        self.diagnostics = {}   # Statistics of the last aggregation, to be logged by the master
+        self.update_workers = [] # Identifier of the worker that sent every update of the round
+        self.history = None     # Running sum (float32) of the updates of every worker over all the rounds (FoolsGold)
+        self.history_rows = {}  # Row of the history of every worker
+        self.reputation = None  # Weight given by FoolsGold to every update of the last round
+
+
+
+    def set_layout(self, weights):
+        """
+        Compute the layout of the flattened parameter vector from a model.
+
+        Parameters
+        ----------
+        weights: List of numpy arrays
+            Model represented as a list of numpy arrays (one per layer)
+        """
+        self.shapes = [np.shape(layer) for layer in weights]
+        sizes = [int(np.prod(shape)) for shape in self.shapes]
+        self.offsets = np.concatenate(([0], np.cumsum(sizes))).astype(int)
+        self.num_params = int(self.offsets[-1])
+        self.dtype = np.result_type(*weights)
+        self.buffer = None
+        self.history = None
+        self.history_rows = {}
+        self.spool = None
+        self.spool_layers = None
+        self.capacity = 0
+        self.num_distances = 0
+        self.accumulator = None
+        self.reference = None
+        self.sketch_counts = None
+        self.sketch_steps = None
+
+
+
+    def check_layout(self, weights):
+        """
+        Recompute the layout (and drop the buffer) only if the model does not match the current layout.
+
+        Parameters
+        ----------
+        weights: List of numpy arrays
+            Model represented as a list of numpy arrays (one per layer)
+        """
+        if self.shapes is None or len(weights) != len(self.shapes) or any(layer_shape(layer) != shape for layer, shape in zip(weights, self.shapes)):
+            self.set_layout(weights)
+
+
+
+    def create_spool(self, num_workers):
+        """
+        Create a memory-mapped file able to store the updates of a given number of workers. For every layer, the
+        updates of all the workers are stored consecutively, so that a chunk of coordinates of a layer is read with
+        one contiguous segment per worker. The file is deleted as soon as it is released.
+
+        Parameters
+        ----------
+        num_workers: Int
+            Number of updates to be stored
+
+        Returns
+        ----------
+        spool: numpy.memmap
+            Memory-mapped file
+
+        spool_layers: List of numpy arrays
+            Views of shape (num_workers, layer_size) of every layer inside the spool
+
+        spool_file: File object
+            Temporary file backing the spool
+        """
+        spool_file = self.create_file(self.spool_dir)
+        spool = np.memmap(spool_file, dtype=self.dtype, mode='w+', shape=(num_workers*self.num_params,))
+        spool_layers = [spool[num_workers*self.offsets[index_layer]:num_workers*self.offsets[index_layer+1]].reshape(num_workers, -1) for index_layer in range(len(self.shapes))]
+        return spool, spool_layers, spool_file
+
+
+
+    def create_file(self, directory):
+        """
+        Create the temporary file backing a memory-mapped buffer. It needs a name if the process pool has to open it.
+
+        Parameters
+        ----------
+        directory: String
+            Directory where the file is created
+
+        Returns
+        ----------
+        spool_file: File object
+            Temporary file, deleted when it is closed
+        """
+        if self.num_jobs > 1 and self.backend == 'process':
+            return tempfile.NamedTemporaryFile(dir=directory, suffix='.spool')
+        return tempfile.TemporaryFile(dir=directory, suffix='.spool')
+
+
+
+    def layer_rows(self, index_layer):
+        """
+        Return the view of shape (n_workers, layer_size) of a layer inside the buffer or the spool.
+
+        Parameters
+        ----------
+        index_layer: Int
+            Index of the layer
+
+        Returns
+        ----------
+        layer_rows: 2-D numpy array
+            View of the layer for all the stored updates
+        """
+        if self.spool is not None:
+            return self.spool_layers[index_layer]
+        return self.buffer[:, self.offsets[index_layer]:self.offsets[index_layer+1]]
+
+
+
+    def allocate(self, num_workers):
+        """
+        Make sure that the buffer (or the spool) can store the updates of a given number of workers. It is only
+        reallocated when it is too small, otherwise it is reused. In streaming mode the updates are never stored, so
+        nothing is allocated.
+
+        Parameters
+        ----------
+        num_workers: Int
+            Number of updates to be stored
+        """
+        if self.streaming:
+            return
+        if self.capacity < num_workers:
+            old_layers = [self.layer_rows(index_layer) for index_layer in range(len(self.shapes))] if self.capacity > 0 else None
+            old_file = self.spool_file # Released once the updates are copied
+            if self.spool_dir is not None:
+                self.spool, self.spool_layers, self.spool_file = self.create_spool(num_workers)
+            elif self.num_jobs > 1 and self.backend == 'process':
+                self.spool_file = self.create_file(SHARED_MEMORY_DIR)
+                self.buffer = np.memmap(self.spool_file, dtype=self.dtype, mode='w+', shape=(num_workers, self.num_params))
+            else:
+                self.buffer = np.empty((num_workers, self.num_params), dtype=self.dtype)
+            new_update_weights = np.ones(num_workers)
+            if old_layers is not None and self.num_updates > 0: # Keep the updates already received
+                for index_layer, old_layer in enumerate(old_layers):
+                    self.layer_rows(index_layer)[:self.num_updates] = old_layer[:self.num_updates]
+                new_update_weights[:self.num_updates] = self.update_weights[:self.num_updates]
+            if old_file is not None and old_file is not self.spool_file:
+                old_file.close()
+            self.update_weights = new_update_weights
+            self.capacity = num_workers
+        if self.needs_distances and (self.distances is None or self.distances.shape[0] < self.capacity):
+            num_rows = self.capacity
+            new_distances = np.zeros((num_rows, num_rows))
+            new_sq_norms = np.zeros(num_rows)
+            if self.distances is not None and self.num_distances > 0:
+                new_distances[:self.num_distances, :self.num_distances] = self.distances[:self.num_distances, :self.num_distances]
+                new_sq_norms[:self.num_distances] = self.sq_norms[:self.num_distances]
+            self.distances = new_distances
+            self.sq_norms = new_sq_norms
+
+
+
+    def set_reference(self, weights):
+        """
+        Store the reference model the updates are compared with (usually the global model sent to the workers).
+
+        Parameters
+        ----------
+        weights: List of numpy arrays
+            Model represented as a list of numpy arrays (one per layer)
+        """
+        self.check_layout(weights)
+        if self.reference is None:
+            self.reference = np.empty(self.num_params, dtype=self.dtype)
+        for index_layer, layer in enumerate(weights):
+            self.reference[self.offsets[index_layer]:self.offsets[index_layer+1]] = np.ravel(layer)
+
+
+
+    def get_reference(self):
+        """
+        Return the flattened reference model. If it has not been set, the aggregate of the previous round is used.
+
+        Returns
+        ----------
+        reference: 1-D numpy array
+            Flattened reference model
+        """
+        if self.reference is not None:
+            return self.reference
+        if self.previous_aggregate is not None and self.previous_aggregate.shape[0] == self.num_params:
+            return self.previous_aggregate
+        raise ValueError('Method %s needs a reference model, call set_reference first' %self.method)
+
+
+
+    def fold(self, weights, weight=1., base=None):
+        """
+        Fold the update of one worker into the accumulator (or the histograms) of the round. The update is not stored.
+
+        Parameters
+        ----------
+        weights: List of numpy arrays
+            Model trained in a worker, represented as a list of numpy arrays (or layers encoded by Update_Compressor,
+            only for the averages)
+
+        weight: float
+            Weight of the update (number of samples of the worker), only used by 'weighted_average'
+
+        base: List of numpy arrays
+            If not None, the update is the difference with this model (only for the averages)
+        """
+        self.check_layout(base if base is not None else weights)
+        if self.needs_sketch:
+            self.fold_sketch(weights)
+            self.num_updates += 1
+            return
+
+        if self.accumulator is None:
+            self.accumulator = np.zeros(self.num_params)
+        if self.num_updates == 0: # First update of the round
+            self.accumulator.fill(0.)
+            self.total_weight = 0.
+            self.update_norms = []
+
+        if self.method == 'clipped_mean':
+            reference = self.get_reference()
+            deltas = [np.ravel(layer) - reference[self.offsets[index_layer]:self.offsets[index_layer+1]] for index_layer, layer in enumerate(weights)]
+            norm = np.sqrt(sum(np.dot(delta, delta) for delta in deltas))
+            self.update_norms.append(norm)
+            factor = min(1., self.clip_threshold / max(norm, 1e-12))
+            for index_layer, delta in enumerate(deltas):
+                self.accumulator[self.offsets[index_layer]:self.offsets[index_layer+1]] += factor*delta
+            self.total_weight += 1.
+        else:
+            weight = weight if self.method == 'weighted_average' else 1.
+            for index_layer, layer in enumerate(weights):
+                segment = self.accumulator[self.offsets[index_layer]:self.offsets[index_layer+1]]
+                if base is not None:
+                    segment += weight*np.ravel(base[index_layer])
+                decode_layer(layer, segment, weight) # Sparse layers are scattered, never densified
+            self.total_weight += weight
+        self.num_updates += 1
+
+
+
+    def fold_sketch(self, weights):
+        """
+        Add the update of one worker to the histograms of every coordinate. The histograms are centered at the reference
+        model, and their range does not depend on any single update: every layer spans sketch_range times the largest
+        change of the layer in the previous round (a robust aggregate). In the first round (or after a null change), the
+        first max(3, 2f + 1) updates are kept and the range is twice the median of their largest deviations in every
+        layer, which f byzantine workers cannot inflate. Values out of the range are counted in the extreme buckets, which keeps their
+        ranks, so the estimated quantile is within one bucket of the exact one whenever the latter lies inside the range.
+
+        Parameters
+        ----------
+        weights: List of numpy arrays
+            Model trained in a worker, represented as a list of numpy arrays
+        """
+        if self.num_updates == 0: # First update of the round
+            if self.sketch_counts is None:
+                self.sketch_counts = np.zeros((self.num_params, self.num_buckets), dtype=np.uint8)
+            self.sketch_counts.fill(0)
+            try:
+                self.sketch_center = np.array(self.get_reference(), dtype=np.float64)
+            except ValueError: # No reference model, histograms of the raw weights
+                self.sketch_center = np.zeros(self.num_params)
+            self.sketch_radius = None
+            self.sketch_pending = []
+            if self.sketch_steps is not None and np.all(self.sketch_steps > 0):
+                self.sketch_radius = self.sketch_range * self.sketch_steps
+        if self.num_updates == np.iinfo(self.sketch_counts.dtype).max: # Wider counts only when they could overflow
+            self.sketch_counts = self.sketch_counts.astype(np.uint16 if self.sketch_counts.dtype == np.uint8 else np.uint32)
+
+        if self.sketch_radius is None: # Range not known yet, keep the update
+            self.sketch_pending.append(weights)
+            if len(self.sketch_pending) >= max(3, 2*self.num_byzantine + 1):
+                self.set_sketch_radius()
+            return
+        self.count_sketch(weights)
+
+
+
+    def set_sketch_radius(self):
+        """
+        Set the range of the histograms of every layer from the updates kept at the start of the round, as twice the
+        median of their largest deviations from the center in the layer, and add those updates to the histograms.
+        """
+        deviations = np.zeros((len(self.sketch_pending), len(self.shapes)))
+        for index_update, weights in enumerate(self.sketch_pending):
+            for index_layer, layer in enumerate(weights):
+                delta = np.ravel(layer) - self.sketch_center[self.offsets[index_layer]:self.offsets[index_layer+1]]
+                deviations[index_update, index_layer] = np.max(np.abs(delta)) if delta.size > 0 else 0.
+        self.sketch_radius = 2*np.median(deviations, axis=0)
+        self.sketch_radius[self.sketch_radius == 0] = 1. # Updates identical to the center
+        for weights in self.sketch_pending:
+            self.count_sketch(weights)
+        self.sketch_pending = []
+
+
+
+    def count_sketch(self, weights):
+        """
+        Increment the bucket of every coordinate of an update.
+
+        Parameters
+        ----------
+        weights: List of numpy arrays
+            Model trained in a worker, represented as a list of numpy arrays
+        """
+        counts = self.sketch_counts.reshape(-1) # Flat view, one bucket per coordinate is incremented
+        for index_layer, layer in enumerate(weights):
+            start, stop = self.offsets[index_layer], self.offsets[index_layer+1]
+            delta = np.ravel(layer) - self.sketch_center[start:stop]
+            radius = self.sketch_radius[index_layer]
+            buckets = np.floor((delta + radius) * (self.num_buckets / (2*radius))).astype(np.int64)
+            np.clip(buckets, 0, self.num_buckets-1, out=buckets) # Values out of the range fall in the extreme buckets
+            buckets += np.arange(start, stop, dtype=np.int64) * self.num_buckets
+            counts[buckets] += 1
+
+
+
+    def sketch_quantile(self):
+        """
+        Estimate the quantile of every coordinate from its histogram, with the same interpolation between order statistics
+        as np.quantile. The values inside a bucket are assumed to be evenly spread.
+
+        Returns
+        ----------
+        flat_weights: 1-D numpy array
+            Estimated quantile of every coordinate
+        """
+        position = self.quantile * (self.num_updates - 1)
+        lower = int(np.floor(position))
+        upper = min(lower + 1, self.num_updates - 1)
+        interpolation = position - lower
+        flat_weights = np.empty(self.num_params)
+        for index_layer in range(len(self.shapes)):
+            first, last = self.offsets[index_layer], self.offsets[index_layer+1]
+            radius = self.sketch_radius[index_layer]
+            width = 2*radius / self.num_buckets
+            for start in range(first, last, self.block_size):
+                stop = min(start+self.block_size, last)
+                cumulative = np.cumsum(self.sketch_counts[start:stop], axis=1, dtype=np.int64)
+                coordinates = np.arange(stop-start)
+                estimates = []
+                for rank in (lower, upper):
+                    bucket = np.argmax(cumulative > rank, axis=1) # Bucket containing the order statistic
+                    previous = np.where(bucket > 0, cumulative[coordinates, bucket-1], 0)
+                    count = cumulative[coordinates, bucket] - previous
+                    estimates.append((bucket + (rank - previous + 0.5) / count) * width)
+                flat_weights[start:stop] = self.sketch_center[start:stop] - radius + (1-interpolation)*estimates[0] + interpolation*estimates[1]
+        return flat_weights
+
+
+
+    def pack(self, weights, weight=1., worker=None, base=None):
+        """
+        Pack the update of one worker into the next free row of the buffer. Encoded layers and differences with a base
+        model are decoded straight into the row.
+
+        Parameters
+        ----------
+        weights: List of numpy arrays
+            Model trained in a worker, represented as a list of numpy arrays (or layers encoded by Update_Compressor)
+
+        weight: float
+            Weight of the update (number of samples of the worker)
+
+        worker: String
+            Identifier of the worker. If None, the position of the update in the round is used
+
+        base: List of numpy arrays
+            If not None, the update is the difference with this model
+        """
+        self.check_layout(base if base is not None else weights)
+        if self.num_updates == self.capacity:
+            self.allocate(max(1, 2*self.num_updates))
+        if self.num_updates == 0:
+            self.update_workers = []
+        self.update_workers.append(worker if worker is not None else self.num_updates)
+
+        for index_layer, layer in enumerate(weights):
+            row = self.layer_rows(index_layer)[self.num_updates]
+            if base is None and not is_encoded(layer):
+                row[:] = np.ravel(layer)
+                continue
+            if base is not None:
+                row[:] = np.ravel(base[index_layer])
+            else:
+                row.fill(0)
+            decode_layer(layer, row)
+        self.update_weights[self.num_updates] = weight
+        self.num_updates += 1
+
+
+
+    def add_update(self, weights, weight=1., worker=None, base=None):
+        """
+        Add the update of one worker as soon as it is received. In streaming mode it is folded into the accumulator.
+        Otherwise it is packed into the buffer and the distances to the updates already received are computed, so
+        that most of the work needed by distance-based methods overlaps with the wait for the remaining workers.
+
+        Parameters
+        ----------
+        weights: List of numpy arrays
+            Model trained in a worker, represented as a list of numpy arrays (or layers encoded by Update_Compressor)
+
+        weight: float
+            Weight of the update (number of samples of the worker)
+
+        worker: String
+            Identifier of the worker, needed by the methods keeping a history of every worker
+
+        base: List of numpy arrays
+            If not None, the update is the difference with this model (for instance, the model sent to the worker)
+        """
+        if (self.streaming and (self.needs_sketch or self.method == 'clipped_mean')) or (self.shapes is None and base is None):
+            weights, base = decode_update(weights, base), None
+        if self.streaming:
+            self.fold(weights, weight, base)
+            return
+        self.pack(weights, weight, worker, base)
+        if self.needs_distances and self.num_distances == self.num_updates-1:
+            self.update_distances(self.num_updates-1)
+
+
+
+    def stack(self, list_weights, list_counts=None):
+        """
+        Pack the updates of all the workers into the buffer (or fold them into the accumulator in streaming mode).
+
+        Parameters
+        ----------
+        list_weights: List of lists of numpy arrays
+            Object containing the models trained in each of the workers
+
+        list_counts: List of floats
+            Weight (number of samples) of every worker. If None, all the workers have the same weight
+        """
+        if list_counts is None:
+            list_counts = np.ones(len(list_weights))
+        self.num_updates = 0
+        self.num_distances = 0
+        if self.streaming:
+            for weights, weight in zip(list_weights, list_counts):
+                self.fold(weights, weight)
+            return
+        self.check_layout(list_weights[0])
+        self.allocate(len(list_weights))
+        for weights, weight in zip(list_weights, list_counts):
+            self.pack(weights, weight)
+
+
+
+    def unstack(self, flat_weights):
+        """
+        Split a flattened parameter vector into per-layer views.
+
+        Parameters
+        ----------
+        flat_weights: 1-D numpy array
+            Flattened parameter vector
+
+        Returns
+        ----------
+        weights: List of numpy arrays
+            Views of flat_weights with the shape of every layer
+        """
+        return [flat_weights[self.offsets[index_layer]:self.offsets[index_layer+1]].reshape(shape) for index_layer, shape in enumerate(self.shapes)]
+
+
+
+    def chunks(self, block_size=None):
+        """
+        Iterate over chunks of coordinates of the updates of the round. Updates kept in RAM are returned as views of the
+        buffer (a single chunk if block_size is None). Spooled updates are read chunk by chunk, without crossing layer
+        boundaries, and every chunk is limited by the memory budget.
+
+        Parameters
+        ----------
+        block_size: Int
+            Maximum number of coordinates in every chunk. If None, it is only limited by the memory budget for spooled updates
+
+        Returns
+        ----------
+        chunks: Generator of tuples (start, stop, chunk)
+            First and last (excluded) coordinates of the chunk in the flattened parameter vector and 2-D array of shape
+            (n_workers, stop - start) with the values of the chunk (a view of the memory-mapped file for spooled updates)
+        """
+        num_workers = self.num_updates
+        if self.spool is None:
+            block_size = block_size if block_size is not None else self.num_params
+            for start in range(0, self.num_params, block_size):
+                yield start, min(start+block_size, self.num_params), self.buffer[:num_workers, start:start+block_size]
+        else:
+            num_columns = max(1, self.memory_budget // (num_workers * (np.dtype(self.dtype).itemsize + 8))) # Room for float64 copies
+            if block_size is not None:
+                num_columns = min(num_columns, block_size)
+            for index_layer, layer in enumerate(self.spool_layers):
+                for start in range(0, layer.shape[1], num_columns):
+                    stop = min(start+num_columns, layer.shape[1])
+                    yield self.offsets[index_layer]+start, self.offsets[index_layer]+stop, layer[:num_workers, start:stop]
+
+
+
+    def get_pool(self, backend):
+        """
+        Return the pool of threads or processes used for the parallel aggregation, which is reused across rounds.
+
+        Parameters
+        ----------
+        backend: String
+            Either 'thread' or 'process'
+
+        Returns
+        ----------
+        pool: concurrent.futures.Executor
+            Pool of threads or processes
+        """
+        if backend == 'process':
+            if self.process_pool is None:
+                self.process_pool = ProcessPoolExecutor(max_workers=self.num_jobs)
+            return self.process_pool
+        if self.thread_pool is None:
+            self.thread_pool = ThreadPoolExecutor(max_workers=self.num_jobs)
+        return self.thread_pool
+
+
+
+    def close(self):
+        """
+        Shut down the pools of threads and processes and release the buffer (or the spool) of the updates. The
+        aggregator can still be used afterwards, everything is created again when needed.
+        """
+        for pool in [self.thread_pool, self.process_pool]:
+            if pool is not None:
+                pool.shutdown()
+        self.thread_pool = None
+        self.process_pool = None
+        self.buffer = None
+        self.spool = None
+        self.spool_layers = None
+        if self.spool_file is not None:
+            self.spool_file.close()
+        self.spool_file = None
+        self.capacity = 0
+        self.num_updates = 0
+
+
+
+    def run_tasks(self, pool, tasks, flat_weights):
+        """
+        Run the reduction of blocks of coordinates in a pool, keeping a bounded number of blocks in flight so that
+        spooled updates are never loaded at once.
+
+        Parameters
+        ----------
+        pool: concurrent.futures.Executor
+            Pool of threads or processes
+
+        tasks: Generator of tuples (start, stop, function, arguments)
+            First and last (excluded) coordinates of every block and call computing the reduction of the block
+
+        flat_weights: 1-D numpy array
+            Flattened parameter vector where the results are written
+        """
+        pending = deque()
+        for start, stop, function, arguments in tasks:
+            pending.append((start, stop, pool.submit(function, *arguments)))
+            if len(pending) >= 2*self.num_jobs:
+                start, stop, future = pending.popleft()
+                flat_weights[start:stop] = future.result()
+        while pending:
+            start, stop, future = pending.popleft()
+            flat_weights[start:stop] = future.result()
+
+
+
+    def reduce_chunks(self, function, block_size=None):
+        """
+        Apply a coordinate-wise reduction over the worker axis chunk by chunk. If num_jobs > 1, blocks of coordinates
+        are reduced in parallel by a pool of threads.
+
+        Parameters
+        ----------
+        function: Function
+            Reduction receiving a 2-D array of shape (n_workers, n_coordinates) and returning a 1-D array of length n_coordinates.
+            The chunk can be modified in place
+
+        block_size: Int
+            Maximum number of coordinates in every chunk
+
+        Returns
+        ----------
+        flat_weights: 1-D numpy array
+            Result of the reduction for every coordinate
+        """
+        spooled = self.spool is not None
+        def reduce_chunk(chunk):
+            return function(np.array(chunk) if spooled else chunk) # Spooled chunks are loaded into RAM by the thread reducing them
+
+        flat_weights = np.empty(self.num_params)
+        if self.num_jobs > 1:
+            pool = self.get_pool('thread') # Also used by the reductions the process backend does not handle
+            tasks = ((start, stop, reduce_chunk, (chunk,)) for start, stop, chunk in self.chunks(block_size if block_size is not None else self.block_size))
+            self.run_tasks(pool, tasks, flat_weights)
+        else:
+            for start, stop, chunk in self.chunks(block_size):
+                flat_weights[start:stop] = reduce_chunk(chunk)
+        return flat_weights
+
+
+
+    def reduce_order_statistic(self, method, k=0, rows=None):
+        """
+        Compute a coordinate-wise order statistic of the updates of the round. With the process backend, blocks of
+        coordinates are sent to the process pool, which reads them from the shared file.
+
+        Parameters
+        ----------
+        method: String
+            Either 'median', 'trimmed_mean' or 'winsorized_mean'
+
+        k: Int
+            Number of values trimmed or clipped at each side of every coordinate
+
+        rows: 1-D numpy array
+            Indexes of the updates to aggregate. If None, all the updates of the round are used
+
+        Returns
+        ----------
+        flat_weights: 1-D numpy array
+            Aggregate of every coordinate
+        """
+        if self.num_jobs == 1 or self.backend != 'process':
+            return self.reduce_chunks(lambda chunk: order_statistic(chunk if rows is None else chunk[rows], method, k))
+
+        itemsize = np.dtype(self.dtype).itemsize
+        if self.spool is None:
+            regions = [(0, (self.capacity, self.num_params), 0)]
+        else:
+            regions = [(self.capacity*self.offsets[index_layer]*itemsize, layer.shape, self.offsets[index_layer]) for index_layer, layer in enumerate(self.spool_layers)]
+
+        def tasks():
+            for offset, shape, first in regions:
+                for start in range(0, shape[1], self.block_size):
+                    stop = min(start+self.block_size, shape[1])
+                    arguments = (self.spool_file.name, np.dtype(self.dtype).str, offset, shape, self.num_updates if rows is None else rows, start, stop, method, k)
+                    yield first+start, first+stop, reduce_shared_block, arguments
+
+        flat_weights = np.empty(self.num_params)
+        self.run_tasks(self.get_pool('process'), tasks(), flat_weights)
+        return flat_weights
+
+
+
+    def update_distances(self, index):
+        """
+        Compute the squared distances between one update and all the previous ones, processing the
+        coordinates in float64 blocks.
+
+        Parameters
+        ----------
+        index: Int
+            Row of the buffer containing the update
+        """
+        sq_norm = 0.
+        dot_products = np.zeros(index)
+        for _, _, block in self.chunks(self.block_size):
+            block = block[:index+1].astype(np.float64)
+            sq_norm += np.dot(block[index], block[index])
+            dot_products += np.dot(block[:index], block[index])
+
+        self.sq_norms[index] = sq_norm
+        distances = np.maximum(self.sq_norms[:index] + sq_norm - 2*dot_products, 0) # ||a||^2 + ||b||^2 - 2a.b
+        self.distances[index, :index] = distances
+        self.distances[:index, index] = distances
+        self.distances[index, index] = 0.
+        self.num_distances = index + 1
+
+
+
+    def pairwise_distances(self):
+        """
+        Compute the squared distances between all the updates in the buffer with a single Gram-matrix product,
+        accumulated over float64 blocks of coordinates.
+
+        Returns
+        ----------
+        distances: 2-D numpy array
+            Matrix of shape (n_workers, n_workers) with the pairwise squared distances
+        """
+        num_workers = self.num_updates
+        if self.num_distances == num_workers:
+            return self.distances[:num_workers, :num_workers] # Already computed as the updates arrived
+
+        gram = np.zeros((num_workers, num_workers))
+        for _, _, block in self.chunks(self.block_size):
+            block = block.astype(np.float64)
+            gram += np.dot(block, block.T)
+        sq_norms = np.diag(gram)
+        distances = np.maximum(sq_norms[:, np.newaxis] + sq_norms[np.newaxis, :] - 2*gram, 0)
+        np.fill_diagonal(distances, 0.)
+        return distances
+
+
+
+    def krum_select(self, distances, num_selected, iterative=False, check_bound=True):
+        """
+        Select the updates with the lowest Krum scores. The score of an update is the sum of the squared distances
+        to its n - f - 2 closest neighbours. Krum only tolerates f byzantine workers if n >= 2f + 3.
+
+        Parameters
+        ----------
+        distances: 2-D numpy array
+            Pairwise squared distances between the updates
+
+        num_selected: Int
+            Number of updates to select
+
+        iterative: Boolean
+            If True, Krum is applied repeatedly, removing the selected update from the candidates and recomputing
+            the scores from the same distance matrix (as required by Bulyan). Otherwise, the scores are computed once (Multi-Krum)
+
+        check_bound: Boolean
+            If True, raise a ValueError when there are fewer than 2f + 3 updates. The later iterations of the
+            iterative selection run on fewer candidates and are not checked
+
+        Returns
+        ----------
+        selected: 1-D numpy array
+            Indexes of the selected updates, in order of selection
+        """
+        num_workers = distances.shape[0]
+        if check_bound and self.num_byzantine > 0 and num_workers < 2*self.num_byzantine + 3:
+            raise ValueError('Krum needs at least 2f + 3 = %d updates to tolerate f = %d byzantine workers, got %d' %(2*self.num_byzantine + 3, self.num_byzantine, num_workers))
+        if iterative:
+            candidates = np.arange(distances.shape[0])
+            selected = []
+            for _ in range(min(num_selected, distances.shape[0])):
+                best = self.krum_select(distances[np.ix_(candidates, candidates)], 1, check_bound=False)[0]
+                selected.append(candidates[best])
+                candidates = np.delete(candidates, best)
+            return np.array(selected, dtype=int)
+
+        num_neighbours = min(max(num_workers - self.num_byzantine - 2, 1), num_workers - 1)
+        if num_neighbours < 1: # A single update
+            return np.arange(num_workers)
+        neighbour_distances = distances + np.diag(np.full(num_workers, np.inf)) # Exclude each update from its own neighbours
+        neighbour_distances.partition(num_neighbours-1, axis=1)
+        scores = np.sum(neighbour_distances[:, :num_neighbours], axis=1)
+        selected = np.argsort(scores, kind='stable')[:num_selected]
+        return selected
+
+
+
+    def bulyan(self):
+        """
+        Bulyan aggregation: n - 2f updates are selected by applying Krum iteratively over the distance matrix of the round,
+        then the coordinate-wise trimmed mean discarding the f largest and f smallest values of the selected updates is computed.
+        The distance matrix and the partial selection of the coordinates are computed only once. Bulyan only tolerates f
+        byzantine workers if n >= 4f + 3.
+
+        Returns
+        ----------
+        flat_weights: 1-D numpy array
+            Bulyan aggregate of the updates
+        """
+        if self.num_byzantine > 0 and self.num_updates < 4*self.num_byzantine + 3:
+            raise ValueError('Bulyan needs at least 4f + 3 = %d updates to tolerate f = %d byzantine workers, got %d' %(4*self.num_byzantine + 3, self.num_byzantine, self.num_updates))
+        selected = self.krum_select(self.pairwise_distances(), max(1, self.num_updates - 2*self.num_byzantine), iterative=True)
+        selected = np.sort(selected)
+        return self.reduce_order_statistic('trimmed_mean', self.num_byzantine, selected)
+
+
+
+    def distances_to(self, point):
+        """
+        Compute the Euclidean distances between every update and a given point, processing the coordinates in float64 blocks.
+
+        Parameters
+        ----------
+        point: 1-D numpy array
+            Flattened parameter vector
+
+        Returns
+        ----------
+        distances: 1-D numpy array
+            Distance from every update to the point
+        """
+        sq_distances = np.zeros(self.num_updates)
+        for start, stop, chunk in self.chunks(self.block_size):
+            diff = chunk.astype(np.float64)
+            diff -= point[start:stop]
+            sq_distances += np.einsum('ij,ij->i', diff, diff)
+        return np.sqrt(sq_distances)
+
+
+
+    def weighted_sum(self, coefficients):
+        """
+        Compute the linear combination of the updates with the given coefficients, processing the coordinates in float64 blocks.
+
+        Parameters
+        ----------
+        coefficients: 1-D numpy array
+            Coefficient of every update
+
+        Returns
+        ----------
+        flat_weights: 1-D numpy array
+            Linear combination of the updates
+        """
+        return self.reduce_chunks(lambda chunk: np.dot(coefficients, chunk.astype(np.float64)), self.block_size)
+
+
+
+    def geometric_median(self):
         """
-        Create a class `Robust_Master` instance.
+        Geometric median of the updates computed with the Weiszfeld algorithm. The iterations start from the
+        aggregate of the previous round (if available) and stop as soon as the estimate does not change anymore.
+
+        Returns
+        ----------
+        flat_weights: 1-D numpy array
+            Geometric median of the updates
+        """
+        if self.previous_aggregate is not None and self.previous_aggregate.shape[0] == self.num_params:
+            median = self.previous_aggregate.astype(np.float64) # Warm start
+        else:
+            median = self.reduce_chunks(lambda chunk: np.mean(chunk, axis=0, dtype=np.float64))
+
+        self.num_iterations = 0
+        for self.num_iterations in range(1, self.max_iter+1):
+            distances = self.distances_to(median)
+            coefficients = 1. / np.maximum(distances, 1e-12) # Smoothed to avoid dividing by zero when the estimate hits an update
+            coefficients /= np.sum(coefficients)
+            new_median = self.weighted_sum(coefficients)
+            step = np.linalg.norm(new_median - median)
+            median = new_median
+            if step <= self.tolerance * max(np.linalg.norm(median), 1e-12):
+                break
+        return median
+
+
+
+    def compute_update_norms(self):
+        """
+        Compute, in a single vectorized pass, the norm of the difference between every update of the round and the reference
+        model. The norms are kept for the clipping and for the diagnostics of the round.
+
+        Returns
+        ----------
+        update_norms: 1-D numpy array
+            Norm of every update relative to the reference model
+        """
+        self.update_norms = self.distances_to(self.get_reference().astype(np.float64))
+        return self.update_norms
+
+
+
+    def get_clip_threshold(self, norms):
+        """
+        Return the clipping threshold of the round.
 
         Parameters
         ----------
-        method: String
-            Name of the aggregation method to use
+        norms: 1-D numpy array
+            Norm of every update
+
+        Returns
+        ----------
+        clip_threshold: float
+            Fixed clip_threshold if given, median of the norms otherwise
         """
-        self.method = method.lower() # Convert string to lowercase
+        return self.clip_threshold if self.clip_threshold is not None else np.median(norms)
+
+
+
+    def clip_towards(self, center, distances, clip_threshold):
+        """
+        Move a center by the mean of the differences between the updates and the center, after clipping their norms.
+
+        Parameters
+        ----------
+        center: 1-D numpy array
+            Flattened parameter vector
+
+        distances: 1-D numpy array
+            Distance from every update to the center
+
+        clip_threshold: float
+            Maximum norm of every difference
+
+        Returns
+        ----------
+        flat_weights: 1-D numpy array
+            center + mean(min(1, clip_threshold / distance) * (update - center))
+        """
+        factors = np.minimum(1., clip_threshold / np.maximum(distances, 1e-12))
+        flat_weights = self.weighted_sum(factors / self.num_updates)
+        flat_weights += (1. - np.mean(factors)) * center
+        return flat_weights
+
+
+
+    def clipped_mean(self):
+        """
+        Mean of the updates after clipping the norm of their difference with the reference model.
+
+        Returns
+        ----------
+        flat_weights: 1-D numpy array
+            Clipped mean of the updates
+        """
+        norms = self.compute_update_norms()
+        return self.clip_towards(self.get_reference().astype(np.float64), norms, self.get_clip_threshold(norms))
+
+
+
+    def centered_clipping(self):
+        """
+        Centered clipping: starting from the aggregate of the previous round (warm start), the center is repeatedly moved by
+        the mean of the clipped differences between the updates and the center. When the center is the reference model,
+        the norms computed for the diagnostics are reused.
+
+        Returns
+        ----------
+        flat_weights: 1-D numpy array
+            Aggregate of the updates
+        """
+        reference = self.get_reference().astype(np.float64)
+        norms = self.compute_update_norms()
+        clip_threshold = self.get_clip_threshold(norms)
+        if self.previous_aggregate is not None and self.previous_aggregate.shape[0] == self.num_params and not np.array_equal(self.previous_aggregate, self.reference):
+            center = self.previous_aggregate.astype(np.float64) # Warm start
+            distances = self.distances_to(center)
+        else:
+            center = reference
+            distances = norms
+
+        for self.num_iterations in range(1, self.clipping_iters+1):
+            new_center = self.clip_towards(center, distances, clip_threshold)
+            step = np.linalg.norm(new_center - center)
+            center = new_center
+            if self.num_iterations == self.clipping_iters or step <= self.tolerance * max(np.linalg.norm(center), 1e-12):
+                break
+            distances = self.distances_to(center)
+        return center
+
+
+
+    def get_history_rows(self, workers):
+        """
+        Return the rows of the history of the given workers, adding rows for the workers seen for the first time.
+
+        Parameters
+        ----------
+        workers: List of strings
+            Identifiers of the workers
+
+        Returns
+        ----------
+        rows: 1-D numpy array
+            Row of the history of every worker
+        """
+        for worker in workers:
+            if worker not in self.history_rows:
+                self.history_rows[worker] = len(self.history_rows)
+        if self.history is None or self.history.shape[0] < len(self.history_rows):
+            new_history = np.zeros((len(self.history_rows), self.num_params), dtype=np.float32)
+            if self.history is not None:
+                new_history[:self.history.shape[0]] = self.history
+            self.history = new_history
+        return np.array([self.history_rows[worker] for worker in workers])
 
 
-    def aggregate(self, list_weights):
+
+    def foolsgold(self):
+        """
+        FoolsGold aggregation. The difference between every update and the reference model is added to the history of its
+        worker, which persists across rounds. Workers whose histories are too similar (cosine similarity computed with a single
+        normalized Gram-matrix product) are considered sybils and down-weighted, with pardoning of the honest workers and a
+        logit confidence function.
+
+        Returns
+        ----------
+        flat_weights: 1-D numpy array
+            Weighted average of the updates
+        """
+        num_workers = self.num_updates
+        reference = self.get_reference()
+        rows = self.get_history_rows(self.update_workers[:num_workers])
+        gram = np.zeros((num_workers, num_workers))
+        for start, stop, chunk in self.chunks(self.block_size):
+            history = self.history[rows, start:stop] + (chunk - reference[start:stop])
+            self.history[rows, start:stop] = history
+            history = history.astype(np.float64)
+            gram += np.dot(history, history.T)
+
+        norms = np.sqrt(np.maximum(np.diag(gram), 1e-12))
+        similarity = gram / np.outer(norms, norms) - np.eye(num_workers) # Cosine similarity with the other workers
+        max_similarity = np.max(similarity, axis=1) if num_workers > 1 else np.zeros(1)
+        pardon = max_similarity[:, np.newaxis] < max_similarity[np.newaxis, :] # Honest workers similar to a sybil are pardoned
+        similarity[pardon] *= (max_similarity[:, np.newaxis] / np.maximum(max_similarity[np.newaxis, :], 1e-12))[pardon]
+        reputation = np.clip(1. - np.max(similarity, axis=1), 0., 1.) if num_workers > 1 else np.ones(1)
+        reputation /= max(np.max(reputation), 1e-12)
+        reputation[reputation == 1.] = .99
+        with np.errstate(divide='ignore'):
+            reputation = np.log(reputation / (1. - reputation)) + 0.5 # Logit
+        reputation = np.clip(reputation, 0., 1.)
+        self.reputation = reputation
+
+        if np.sum(reputation) == 0:
+            return reference.astype(np.float64)
+        return self.weighted_sum(reputation / np.sum(reputation))
+
+
+
+    def num_trimmed(self, num_workers):
+        """
+        Number of workers trimmed at each side of every coordinate.
+
+        Parameters
+        ----------
+        num_workers: Int
+            Number of updates being aggregated
+
+        Returns
+        ----------
+        k: Int
+            Number of values discarded at each side, at least one value is always kept
+        """
+        return min(int(self.trim_fraction*num_workers), (num_workers-1)//2)
+
+
+
+    def min_updates(self):
+        """
+        Minimum number of updates the aggregation needs to tolerate num_byzantine byzantine workers: 2f + 3 for Krum
+        and Multi-Krum, 4f + 3 for Bulyan, and a single update for the rest of methods.
+
+        Returns
+        ----------
+        num_updates: Int
+            Minimum number of updates in a round
+        """
+        if self.num_byzantine > 0 and self.method in ['krum', 'multikrum']:
+            return 2*self.num_byzantine + 3
+        if self.num_byzantine > 0 and self.method == 'bulyan':
+            return 4*self.num_byzantine + 3
+        return 1
+
+
+
+    def get_state(self):
+        """
+        State kept across rounds, to be stored in a checkpoint: the aggregate of the previous round (warm start), the
+        history of every worker (FoolsGold) and the range of the histograms (approximate quantiles). The arrays are copies, so that they can be written while the next rounds
+        are aggregated. The buffers of the current round are not included.
+
+        Returns
+        ----------
+        state: Dictionary
+            Numpy arrays and JSON serializable values
+        """
+        workers = sorted(self.history_rows, key=self.history_rows.get) # Workers in the order of their rows
+        return {'shapes': [list(shape) for shape in self.shapes] if self.shapes is not None else None,
+                'dtype': np.dtype(self.dtype).str if self.shapes is not None else None,
+                'previous_aggregate': self.previous_aggregate.copy() if self.previous_aggregate is not None else None,
+                'history': self.history[:len(workers)].copy() if self.history is not None else None,
+                'history_workers': workers,
+                'reputation': self.reputation.copy() if self.reputation is not None else None,
+                'sketch_steps': self.sketch_steps.copy() if self.sketch_steps is not None else None}
+
+
+
+    def set_state(self, state):
+        """
+        Restore the state returned by `get_state`.
+
+        Parameters
+        ----------
+        state: Dictionary
+            State stored in a checkpoint
+        """
+        if state.get('shapes') is not None:
+            self.set_layout([np.empty(shape, dtype=state['dtype']) for shape in state['shapes']]) # Only the shapes and dtype are used
+        self.previous_aggregate = state.get('previous_aggregate')
+        self.reputation = state.get('reputation')
+        self.history = state.get('history')
+        self.history_rows = {worker: row for row, worker in enumerate(state.get('history_workers') or [])}
+        self.sketch_steps = state.get('sketch_steps')
+
+
+
+    def aggregate(self, list_weights=None, list_counts=None):
         """
         Method for aggregating models.
 
@@ -35,62 +1427,532 @@ class Robust_Master:
         ----------
         list_weights: List of lists of numpy arrays
             Object containing the models trained in each of the workers. Each model from a worker is represented as a list of numpy arrays.
+            If None, the updates already added with `add_update` are aggregated.
+
+        list_counts: List of floats
+            Weight (number of samples) of every worker, only used by 'weighted_average'
 
         Returns
         ----------
         new_weights: List of numpy arrays
             Object containing the aggregated model combining all the models from the different workers
         """
-        if self.method == 'average':
-            new_weights = []
-            for index_layer in range(len(list_weights[0])):
-                layer_weights = []
-                for worker in range(len(list_weights)):
-                    layer_weights.append(list_weights[worker][index_layer])                 
-                mean_weights = np.mean(layer_weights, axis=0) # Average layer weights for all workers
-                new_weights.append(mean_weights)
+        if list_weights is not None and len(list_weights) != self.num_updates:
+            self.stack(list_weights, list_counts)
+        if self.num_updates == 0:
+            raise ValueError('No updates to aggregate')
+
+        if self.needs_sketch: # The updates were added to the histograms as they arrived
+            if self.sketch_radius is None: # Fewer than max(3, 2f + 1) updates in the round
+                self.set_sketch_radius()
+            flat_weights = self.sketch_quantile()
+            self.sketch_steps = np.zeros(len(self.shapes)) # Largest change of every layer, sets the range of the next round
+            for index_layer in range(len(self.shapes)):
+                start, stop = self.offsets[index_layer], self.offsets[index_layer+1]
+                if stop > start:
+                    self.sketch_steps[index_layer] = np.max(np.abs(flat_weights[start:stop] - self.sketch_center[start:stop]))
+
+        elif self.streaming: # The updates were accumulated as they arrived
+            flat_weights = self.accumulator / self.total_weight
+            if self.method == 'clipped_mean':
+                flat_weights += self.get_reference()
+
+        elif self.method == 'average':
+            flat_weights = self.reduce_chunks(lambda chunk: np.mean(chunk, axis=0)) # Average weights for all workers
+
+        elif self.method == 'weighted_average':
+            flat_weights = self.weighted_sum(self.update_weights[:self.num_updates] / np.sum(self.update_weights[:self.num_updates]))
+
+        elif self.method == 'clipped_mean':
+            flat_weights = self.clipped_mean()
+
+        elif self.method == 'centered_clipping':
+            flat_weights = self.centered_clipping()
+
+        elif self.method == 'foolsgold':
+            flat_weights = self.foolsgold()
 
         elif self.method == 'median':
-            new_weights = []
-            for index_layer in range(len(list_weights[0])):
-                layer_weights = []
-                for worker in range(len(list_weights)):
-                    layer_weights.append(list_weights[worker][index_layer])                 
-                mean_weights = np.median(layer_weights, axis=0) # Calculate the median of layer weights for all workers
-                new_weights.append(mean_weights)
+            flat_weights = self.reduce_order_statistic('median') # Calculate the median of weights for all workers
+
+        elif self.method == 'trimmed_mean':
+            flat_weights = self.reduce_order_statistic('trimmed_mean', self.num_trimmed(self.num_updates))
+
+        elif self.method == 'bulyan':
+            flat_weights = self.bulyan()
+
+        elif self.method == 'geometric_median':
+            flat_weights = self.geometric_median()
+
+        elif self.method == 'krum':
+            best = self.krum_select(self.pairwise_distances(), 1)[0]
+            flat_weights = self.reduce_chunks(lambda chunk: chunk[best])
+
+        elif self.method == 'multikrum':
+            num_selected = self.num_selected if self.num_selected is not None else self.num_updates - self.num_byzantine
+            selected = np.sort(self.krum_select(self.pairwise_distances(), max(1, num_selected)))
+            flat_weights = self.reduce_chunks(lambda chunk: np.mean(chunk[selected], axis=0))
+
+        elif self.method == 'winsorized_mean':
+            flat_weights = self.reduce_order_statistic('winsorized_mean', self.num_trimmed(self.num_updates))
+
+        else:
+            raise ValueError('Unknown aggregation method: %s' %self.method)
+
+        self.diagnostics = {'num_updates': self.num_updates}
+        if self.method == 'foolsgold':
+            self.diagnostics['reputation'] = dict(zip(self.update_workers, self.reputation))
+        if len(self.update_norms) > 0:
+            norms = np.asarray(self.update_norms)
+            clip_threshold = self.get_clip_threshold(norms)
+            self.diagnostics.update({'norm_min': np.min(norms), 'norm_median': np.median(norms), 'norm_max': np.max(norms),
+                                     'clip_threshold': clip_threshold, 'num_clipped': int(np.sum(norms > clip_threshold))})
+        self.update_norms = []
+
+        self.num_updates = 0 # The buffer is reused in the next round
+        self.num_distances = 0
+        self.previous_aggregate = flat_weights.astype(self.dtype, copy=False)
+        new_weights = self.unstack(self.previous_aggregate)
 
         return new_weights
-        
+
 
 
 
 class Robust_Worker:
     """
     This class implements robust training methods for different algorithms, runs at Worker node.
+
+    The training data is read in chunks of a fixed number of rows, so that it can be a memory-mapped array
+    (or any object supporting slicing along the first axis) larger than the available RAM.
     """
-    def __init__(self):
+    def __init__(self, outlier_method=None, chunk_size=4096, outlier_quantile=0.999, zscore_threshold=3.5, shrinkage=0.1, per_class=True, sample_size=10000,
+                 adversarial_method=None, epsilon=0.1, num_steps=10, step_size=None, random_start=True, clip_min=None, clip_max=None, adversarial_fraction=0.5, lazy=True):
         """
         Create a class `Robust_Worker` instance.
 
         Parameters
         ----------
+        outlier_method: String
+            Method used to prefilter the training data: 'mahalanobis' (distance to the mean with a shrinkage covariance, reweighted
+            once without the outliers found), 'zscore' (root mean square of the robust z-scores, based on the median and the MAD)
+            or None (no prefiltering, the default)
+
+        chunk_size: Int
+            Number of rows of the training data processed at once
+
+        outlier_quantile: float
+            Quantile of the chi-square distribution used as threshold of the squared Mahalanobis distance
+
+        zscore_threshold: float
+            Maximum root mean square of the robust z-scores of the features of a row
+
+        shrinkage: float
+            Weight (between 0 and 1) of the scaled identity in the shrinkage covariance
+
+        per_class: Boolean
+            If True and the labels are given, the statistics are computed for every class, so that rows with a flipped label are also detected
+
+        sample_size: Int
+            Number of random rows used to estimate the median and the MAD in 'zscore'
+
+        adversarial_method: String
+            Method used to generate adversarial samples during the local training: 'fgsm', 'pgd' or None (no adversarial training)
+
+        epsilon: float
+            Maximum perturbation of every feature (infinity norm)
+
+        num_steps: Int
+            Number of gradient steps of 'pgd'
+
+        step_size: float
+            Size of every step of 'pgd'. If None, 2.5*epsilon/num_steps is used
+
+        random_start: Boolean
+            If True, 'pgd' starts from a random point of the epsilon ball
+
+        clip_min, clip_max: float
+            Valid range of the features. If None, the samples are not clipped
+
+        adversarial_fraction: float
+            Fraction of every training batch replaced by its adversarial samples
+
+        lazy: Boolean
+            If True, the adversarial samples are generated for every batch inside the training loop. Otherwise an adversarial
+            copy of the training data is generated before every local training and appended to it
+        """
+        self.outlier_method = outlier_method.lower() if outlier_method is not None else None
+        self.chunk_size = chunk_size
+        self.outlier_quantile = outlier_quantile
+        self.zscore_threshold = zscore_threshold
+        self.shrinkage = shrinkage
+        self.per_class = per_class
+        self.sample_size = sample_size
+        self.adversarial_method = adversarial_method.lower() if adversarial_method is not None else None
+        self.epsilon = epsilon
+        self.num_steps = num_steps
+        self.step_size = step_size if step_size is not None else 2.5*epsilon/num_steps
+        self.random_start = random_start
+        self.clip_min = clip_min
+        self.clip_max = clip_max
+        self.adversarial_fraction = adversarial_fraction
+        self.lazy = lazy
+
+
+
+    def perturb(self, x, y, input_gradients):
+        """
+        Adversarial samples of a batch, computed with one gradient call per step for the whole batch.
+
+        Parameters
+        ----------
+        x: numpy array
+            Batch of patterns
+
+        y: numpy array
+            Labels of the batch
+
+        input_gradients: Function
+            Function returning the gradient of the loss with respect to the inputs for a batch of patterns and labels
+
+        Returns
+        ----------
+        samples: numpy array
+            Adversarial samples of the batch
+        """
+        x = np.asarray(x)
+        if not np.issubdtype(x.dtype, np.floating):
+            x = x.astype(np.float32)
+        clip = self.clip_min is not None or self.clip_max is not None
+
+        if self.adversarial_method == 'fgsm':
+            samples = np.sign(input_gradients(x, y)).astype(x.dtype)
+            samples *= self.epsilon
+            samples += x
+            if clip:
+                np.clip(samples, self.clip_min, self.clip_max, out=samples)
+
+        elif self.adversarial_method == 'pgd':
+            lower, upper = x - self.epsilon, x + self.epsilon
+            samples = x + np.random.uniform(-self.epsilon, self.epsilon, x.shape).astype(x.dtype) if self.random_start else x.copy()
+            for _ in range(self.num_steps):
+                samples += (self.step_size*np.sign(input_gradients(samples, y))).astype(x.dtype, copy=False)
+                np.clip(samples, lower, upper, out=samples) # Projection onto the epsilon ball
+                if clip:
+                    np.clip(samples, self.clip_min, self.clip_max, out=samples)
+
+        else:
+            raise ValueError('Unknown adversarial method: %s' %self.adversarial_method)
+
+        return samples
+
+
+
+    def generate_samples(self, X, y, input_gradients, batch_size=None):
+        """
+        Method for generating samples at worker in order to cope with adversarial attachs at test time. The
+        samples are generated for whole batches of patterns at once.
+
+        Parameters
+        ----------
+        X: numpy array
+            Patterns, one per row
+
+        y: numpy array
+            Labels of the patterns
+
+        input_gradients: Function
+            Function returning the gradient of the loss with respect to the inputs for a batch of patterns and labels
+
+        batch_size: Int
+            Number of patterns perturbed at once. If None, chunk_size is used
+
+        Returns
+        ----------
+        samples: numpy array
+            Adversarial sample of every pattern
+        """
+        batch_size = batch_size if batch_size is not None else self.chunk_size
+        if X.shape[0] <= batch_size:
+            return self.perturb(X, y, input_gradients)
+        samples = None
+        for start in range(0, X.shape[0], batch_size):
+            batch = self.perturb(X[start:start+batch_size], y[start:start+batch_size], input_gradients)
+            if samples is None:
+                samples = np.empty(X.shape, dtype=batch.dtype)
+            samples[start:start+batch.shape[0]] = batch
+        return samples
+
+
+
+    def get_groups(self, num_rows, y=None):
+        """
+        Group of every row of the training data (its class, or a single group).
+
+        Parameters
+        ----------
+        num_rows: Int
+            Number of rows of the training data
+
+        y: numpy array
+            Labels, either one-hot encoded or as a vector
+
+        Returns
+        ----------
+        groups: 1-D numpy array
+            Group of every row
+
+        num_groups: Int
+            Number of groups
+        """
+        if y is None or not self.per_class:
+            return np.zeros(num_rows, dtype=int), 1
+        y = np.asarray(y)
+        labels = np.argmax(y, axis=1) if y.ndim > 1 and y.shape[1] > 1 else np.ravel(y)
+        classes, groups = np.unique(labels, return_inverse=True)
+        return groups, len(classes)
+
+
+
+    def chunks(self, X):
+        """
+        Iterate over the training data in chunks of rows, flattened and converted to float64.
+
+        Parameters
+        ----------
+        X: numpy array
+            Training data, one pattern per row (of any shape)
+
+        Returns
+        ----------
+        start: Int
+            Index of the first row of the chunk
+
+        chunk: 2-D numpy array
+            Rows of the chunk
+        """
+        for start in range(0, X.shape[0], self.chunk_size):
+            chunk = np.asarray(X[start:start+self.chunk_size], dtype=np.float64)
+            yield start, chunk.reshape(chunk.shape[0], -1)
+
+
+
+    def gaussian_estimates(self, X, groups, num_groups, previous=None, threshold=None):
+        """
+        Mean and precision matrix (inverse of the shrinkage covariance) of every group, accumulated chunk by chunk.
+
+        Parameters
+        ----------
+        X: numpy array
+            Training data, one pattern per row
+
+        groups: 1-D numpy array
+            Group of every row
+
+        num_groups: Int
+            Number of groups
+
+        previous: List of tuples
+            If not None, estimates of a previous pass. Only the rows within the threshold under them are accumulated
+
+        threshold: float
+            Maximum squared Mahalanobis distance of the rows accumulated
+
+        Returns
+        ----------
+        estimates: List of tuples
+            (mean, precision) of every group, or None for groups with less than two rows
+        """
+        counts = np.zeros(num_groups)
+        sums = None
+        for start, chunk in self.chunks(X):
+            if sums is None:
+                num_features = chunk.shape[1]
+                sums = np.zeros((num_groups, num_features))
+                products = np.zeros((num_groups, num_features, num_features))
+            chunk_groups = groups[start:start+chunk.shape[0]]
+            if previous is not None:
+                keep = self.mahalanobis_distances(chunk, chunk_groups, previous) <= threshold
+                chunk, chunk_groups = chunk[keep], chunk_groups[keep]
+            for group in np.unique(chunk_groups):
+                rows = chunk[chunk_groups == group]
+                counts[group] += rows.shape[0]
+                sums[group] += np.sum(rows, axis=0)
+                products[group] += np.dot(rows.T, rows)
+
+        estimates = []
+        for group in range(num_groups):
+            if counts[group] < 2:
+                estimates.append(None)
+                continue
+            mean = sums[group] / counts[group]
+            covariance = products[group] / counts[group] - np.outer(mean, mean)
+            scale = np.trace(covariance) / num_features
+            covariance *= 1. - self.shrinkage
+            covariance[np.diag_indices(num_features)] += self.shrinkage*(scale if scale > 0 else 1.)
+            estimates.append((mean, np.linalg.pinv(covariance)))
+        return estimates
+
+
+
+    def mahalanobis_distances(self, chunk, chunk_groups, estimates):
+        """
+        Squared Mahalanobis distance of every row of a chunk to the mean of its group.
+
+        Parameters
+        ----------
+        chunk: 2-D numpy array
+            Rows of the chunk
+
+        chunk_groups: 1-D numpy array
+            Group of every row of the chunk
+
+        estimates: List of tuples
+            (mean, precision) of every group
+
+        Returns
+        ----------
+        distances: 1-D numpy array
+            Squared distance of every row (0 for the groups without estimate)
+        """
+        distances = np.zeros(chunk.shape[0])
+        for group in np.unique(chunk_groups):
+            if estimates[group] is None:
+                continue
+            mean, precision = estimates[group]
+            rows = chunk_groups == group
+            centered = chunk[rows] - mean
+            distances[rows] = np.sum(np.dot(centered, precision)*centered, axis=1)
+        return distances
+
+
+
+    def zscore_estimates(self, X, groups, num_groups):
+        """
+        Median and scale (MAD) of every feature in every group, estimated on a random sample of rows.
+
+        Parameters
+        ----------
+        X: numpy array
+            Training data, one pattern per row
+
+        groups: 1-D numpy array
+            Group of every row
+
+        num_groups: Int
+            Number of groups
+
+        Returns
+        ----------
+        estimates: List of tuples
+            (median, scale) of every group, or None for groups with less than two rows in the sample
         """
+        num_rows = X.shape[0]
+        random_state = np.random.RandomState(0)
+        indexes = np.sort(random_state.choice(num_rows, min(num_rows, self.sample_size), replace=False)) # Sorted, so that a memory map is read sequentially
+        sample = np.asarray(X[indexes], dtype=np.float64).reshape(len(indexes), -1)
+        sample_groups = groups[indexes]
+
+        estimates = []
+        for group in range(num_groups):
+            rows = sample[sample_groups == group]
+            if rows.shape[0] < 2:
+                estimates.append(None)
+                continue
+            median = np.median(rows, axis=0)
+            deviations = np.abs(rows - median)
+            scale = 1.4826*np.median(deviations, axis=0)
+            constant = scale == 0
+            scale[constant] = 1.2533*np.mean(deviations[:, constant], axis=0) # Mean absolute deviation when more than half of the values are equal
+            scale[scale == 0] = np.inf # Constant features are ignored
+            estimates.append((median, scale))
+        return estimates
 
 
-    def generate_samples(self):
+
+    def prefilter_outliers(self, X, y=None):
         """
-        Method for generating samples at worker in order to cope with adversarial attachs at test time.
+        Method for prefiltering outliers at worker. The training data is read in chunks, so the rows to keep are
+        returned instead of a filtered copy.
 
         Parameters
         ----------
+        X: numpy array
+            Training data, one pattern per row
+
+        y: numpy array
+            Labels of the training data (one-hot encoded or as a vector). If given and per_class is True, the
+            statistics are computed for every class
+
+        Returns
+        ----------
+        inliers: 1-D numpy array
+            Boolean mask of the rows that are kept
         """
+        num_rows = X.shape[0]
+        inliers = np.ones(num_rows, dtype=bool)
+        if self.outlier_method is None:
+            return inliers
+        groups, num_groups = self.get_groups(num_rows, y)
+
+        if self.outlier_method == 'mahalanobis':
+            num_features = int(np.prod(X.shape[1:]))
+            threshold = chi2_quantile(self.outlier_quantile, num_features)
+            estimates = self.gaussian_estimates(X, groups, num_groups)
+            estimates = self.gaussian_estimates(X, groups, num_groups, estimates, threshold) # Reweighted without the outliers of the first pass
+            for start, chunk in self.chunks(X):
+                inliers[start:start+chunk.shape[0]] = self.mahalanobis_distances(chunk, groups[start:start+chunk.shape[0]], estimates) <= threshold
 
+        elif self.outlier_method == 'zscore':
+            estimates = self.zscore_estimates(X, groups, num_groups)
+            for start, chunk in self.chunks(X):
+                chunk_groups = groups[start:start+chunk.shape[0]]
+                for group in np.unique(chunk_groups):
+                    if estimates[group] is None:
+                        continue
+                    median, scale = estimates[group]
+                    rows = np.flatnonzero(chunk_groups == group)
+                    scores = np.sqrt(np.mean(((chunk[rows] - median) / scale)**2, axis=1))
+                    inliers[start + rows] = scores <= self.zscore_threshold
 
-    def prefilter_outliers(self):
+        else:
+            raise ValueError('Unknown outlier method: %s' %self.outlier_method)
+
+        return inliers
+
+
+
+    def select_rows(self, X, inliers):
         """
-        Method for prefiltering outliers at worker.
+        Keep the rows of the training data given by a mask. A memory-mapped array is copied chunk by chunk to a new
+        memory-mapped file in the same directory (or the temporary directory), so that the filtered data is never
+        loaded in RAM. Other arrays are filtered in memory.
 
         Parameters
         ----------
+        X: numpy array
+            Training data, one pattern per row
+
+        inliers: 1-D numpy array
+            Boolean mask of the rows that are kept
+
+        Returns
+        ----------
+        X_kept: numpy array
+            Rows of the training data that are kept
         """
-        
+        if np.all(inliers):
+            return X
+        if not isinstance(X, np.memmap):
+            return X[inliers]
+        rows = np.flatnonzero(inliers)
+        directory = os.path.dirname(X.filename) if getattr(X, 'filename', None) else None
+        handle, path = tempfile.mkstemp(dir=directory, suffix='.dat')
+        os.close(handle)
+        X_kept = np.memmap(path, dtype=X.dtype, mode='w+', shape=(rows.size,) + X.shape[1:])
+        if os.name == 'posix':
+            os.remove(path) # The mapping keeps the data, nothing is left on disk when it is released
+        for start in range(0, rows.size, self.chunk_size):
+            X_kept[start:start+self.chunk_size] = X[rows[start:start+self.chunk_size]]
+        X_kept.flush()
+        return X_kept